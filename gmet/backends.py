@@ -0,0 +1,208 @@
+#Cache backends: where cached values and request counters live.
+#MemoryBackend (see memorybackend.py) keeps them in the process, SqliteBackend shares them between the workers of a node through a memory mapped
+#database file (in /dev/shm by default), RedisBackend shares them between all the replicas through a Redis compatible server.
+#Values are strings (callers serialize them, usually as JSON), counters are integers grouped in named hashes.
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+from gmet.memorybackend import CacheBackendError, CacheBackend, MemoryBackend
+
+
+#SQLite database shared by the processes of a node. Each thread has its own connection; the file is memory mapped and,
+#when in /dev/shm, never touches the disk. At most iMaxEntries values are kept, the ones expiring first are purged
+class SqliteBackend(CacheBackend):
+    shared = True
+    PURGE_EVERY = 100
+
+    def __init__(self, iPath=None, iMaxEntries=4096, iClock=time.time):
+        if iPath is None:
+            import tempfile
+            aDir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            iPath = os.path.join(aDir, 'gmet-cache.db')
+        self.path = iPath
+        self.maxEntries = iMaxEntries
+        self._clock = iClock
+        self._local = threading.local()
+        self._sets = 0
+        aConnection = self._connection()
+        with aConnection:
+            aConnection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, expiresAt REAL)')
+            aConnection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT, field TEXT, count INTEGER, PRIMARY KEY (name, field))')
+
+    def _connection(self):
+        aConnection = getattr(self._local, 'connection', None)
+        if aConnection is None:
+            try:
+                aConnection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+                aConnection.execute('PRAGMA journal_mode=WAL')
+                aConnection.execute('PRAGMA synchronous=OFF')
+                aConnection.execute('PRAGMA mmap_size=67108864')
+            except sqlite3.Error as error:
+                raise CacheBackendError('Cannot open {}: {}'.format(self.path, error))
+            self._local.connection = aConnection
+        return aConnection
+
+    def _execute(self, iQuery, iParameters=()):
+        try:
+            return self._connection().execute(iQuery, iParameters)
+        except sqlite3.Error as error:
+            raise CacheBackendError('{} failed on {}: {}'.format(iQuery.split()[0], self.path, error))
+
+    def get(self, iKey):
+        aRow = self._execute('SELECT value FROM entries WHERE key = ? AND (expiresAt IS NULL OR expiresAt > ?)', (iKey, self._clock())).fetchone()
+        return None if aRow is None else aRow[0]
+
+    def set(self, iKey, iValue, iTTL=None):
+        self._execute('INSERT OR REPLACE INTO entries (key, value, expiresAt) VALUES (?, ?, ?)', (iKey, iValue, None if iTTL is None else self._clock() + iTTL))
+        self._sets += 1
+        if self._sets % SqliteBackend.PURGE_EVERY == 0:
+            self.purge()
+
+    #Drop the expired values, then the ones expiring first when there are more than maxEntries
+    def purge(self):
+        self._execute('DELETE FROM entries WHERE expiresAt <= ?', (self._clock(),))
+        self._execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expiresAt IS NULL, expiresAt LIMIT max(0, (SELECT count(*) FROM entries) - ?))', (self.maxEntries,))
+
+    def delete(self, iKey):
+        self._execute('DELETE FROM entries WHERE key = ?', (iKey,))
+
+    def incr(self, iName, iField, iAmount=1):
+        self._execute('INSERT INTO counters (name, field, count) VALUES (?, ?, ?) ON CONFLICT (name, field) DO UPDATE SET count = count + excluded.count', (iName, iField, iAmount))
+        return self._execute('SELECT count FROM counters WHERE name = ? AND field = ?', (iName, iField)).fetchone()[0]
+
+    def getCounters(self, iName):
+        return dict(self._execute('SELECT field, count FROM counters WHERE name = ?', (iName,)).fetchall())
+
+    def setCounter(self, iName, iField, iValue):
+        self._execute('INSERT OR REPLACE INTO counters (name, field, count) VALUES (?, ?, ?)', (iName, iField, iValue))
+
+    def deleteCounter(self, iName, iField):
+        self._execute('DELETE FROM counters WHERE name = ? AND field = ?', (iName, iField))
+
+    def close(self):
+        aConnection = getattr(self._local, 'connection', None)
+        if aConnection is not None:
+            aConnection.close()
+            self._local.connection = None
+
+
+#Minimal client of the Redis protocol (RESP), enough for the few commands used here. One connection per thread.
+#Keys are prefixed with iPrefix so that several applications can share a server
+class RedisBackend(CacheBackend):
+    shared = True
+
+    def __init__(self, iHost='localhost', iPort=6379, iDb=0, iPrefix='gmet:', iTimeout=1):
+        self.host = iHost
+        self.port = iPort
+        self.db = iDb
+        self.prefix = iPrefix
+        self.timeout = iTimeout
+        self._local = threading.local()
+
+    def _connection(self):
+        aConnection = getattr(self._local, 'connection', None)
+        if aConnection is None:
+            aSocket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            aConnection = self._local.connection = (aSocket, aSocket.makefile('rb'))
+            if self.db:
+                self._send(aConnection, ['SELECT', str(self.db)])
+        return aConnection
+
+    @staticmethod
+    def _encode(iArgs):
+        aParts = [b'*%d\r\n' % len(iArgs)]
+        for aArg in iArgs:
+            aBytes = aArg if isinstance(aArg, bytes) else str(aArg).encode('utf-8')
+            aParts.append(b'$%d\r\n%s\r\n' % (len(aBytes), aBytes))
+        return b''.join(aParts)
+
+    @staticmethod
+    def _read(iFile):
+        aLine = iFile.readline()
+        if not aLine:
+            raise CacheBackendError('Connection closed by the Redis server')
+        aType, aData = aLine[:1], aLine[1:-2]
+        if aType == b'+':
+            return aData.decode('utf-8')
+        if aType == b'-':
+            raise CacheBackendError('Redis error: ' + aData.decode('utf-8'))
+        if aType == b':':
+            return int(aData)
+        if aType == b'$':
+            aLength = int(aData)
+            if aLength < 0:
+                return None
+            aValue = iFile.read(aLength + 2)[:-2]
+            return aValue.decode('utf-8')
+        if aType == b'*':
+            aLength = int(aData)
+            return None if aLength < 0 else [RedisBackend._read(iFile) for i in range(aLength)]
+        raise CacheBackendError('Unexpected Redis answer: {!r}'.format(aLine))
+
+    def _send(self, iConnection, iArgs):
+        iConnection[0].sendall(RedisBackend._encode(iArgs))
+        return RedisBackend._read(iConnection[1])
+
+    #Run one command, a broken connection is dropped so that the next command reconnects
+    def command(self, *iArgs):
+        try:
+            return self._send(self._connection(), iArgs)
+        except (OSError, ValueError) as error:
+            self.close()
+            if isinstance(error, CacheBackendError):
+                raise
+            raise CacheBackendError('Redis {}:{} unavailable: {}'.format(self.host, self.port, error))
+
+    def get(self, iKey):
+        return self.command('GET', self.prefix + iKey)
+
+    def set(self, iKey, iValue, iTTL=None):
+        if iTTL is None:
+            self.command('SET', self.prefix + iKey, iValue)
+        elif iTTL <= 0:
+            self.command('DEL', self.prefix + iKey)
+        else:
+            self.command('SET', self.prefix + iKey, iValue, 'EX', max(1, int(iTTL)))
+
+    def delete(self, iKey):
+        self.command('DEL', self.prefix + iKey)
+
+    def incr(self, iName, iField, iAmount=1):
+        return self.command('HINCRBY', self.prefix + iName, iField, iAmount)
+
+    def getCounters(self, iName):
+        aItems = self.command('HGETALL', self.prefix + iName) or []
+        return {aItems[i]: int(aItems[i+1]) for i in range(0, len(aItems), 2)}
+
+    def setCounter(self, iName, iField, iValue):
+        self.command('HSET', self.prefix + iName, iField, iValue)
+
+    def deleteCounter(self, iName, iField):
+        self.command('HDEL', self.prefix + iName, iField)
+
+    def close(self):
+        aConnection = getattr(self._local, 'connection', None)
+        if aConnection is not None:
+            self._local.connection = None
+            try:
+                aConnection[1].close()
+                aConnection[0].close()
+            except OSError:
+                pass
+
+
+#Build a backend from its url: memory, sqlite:///path/to/file.db (sqlite: alone for the default file) or redis://host:port/db
+def createBackend(iUrl):
+    from urllib.parse import urlsplit
+    aParts = urlsplit(iUrl or 'memory')
+    if aParts.scheme in ('', 'memory') and aParts.path in ('', 'memory'):
+        return MemoryBackend()
+    if aParts.scheme == 'sqlite':
+        return SqliteBackend(aParts.path or None)
+    if aParts.scheme == 'redis':
+        aDb = aParts.path.strip('/')
+        return RedisBackend(aParts.hostname or 'localhost', aParts.port or 6379, int(aDb) if aDb else 0)
+    raise ValueError('Unknown cache backend: ' + iUrl)
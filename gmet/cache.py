@@ -0,0 +1,271 @@
+#In-process caches used by the web server to avoid hitting the upstream services on every request
+
+import time
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+
+#One cached value, with the time it was stored at, its version and its own time to live when it differs from the cache one.
+#modifiedAt is the time its version was first stored, it does not change when the same version is stored again
+class CacheEntry(object):
+    __slots__ = ('value', 'storedAt', 'version', 'ttl', 'modifiedAt')
+
+    def __init__(self, iValue, iStoredAt, iVersion, iTTL=None, iModifiedAt=None):
+        self.value = iValue
+        self.storedAt = iStoredAt
+        self.version = iVersion
+        self.ttl = iTTL
+        self.modifiedAt = iStoredAt if iModifiedAt is None else iModifiedAt
+
+
+#Thread-safe cache with a time to live, LRU eviction once iMaxSize is reached and stale-while-revalidate:
+#an entry older than iTTL but younger than iTTL+iStaleTTL is still served immediately while a background
+#thread refreshes it. Entries older than that are dropped and reloaded synchronously.
+#With iKeepExpired, older entries are kept until evicted instead, and served as last known good value when reloading them fails
+#with an IOError (e.g. upstream down or its circuit breaker open).
+#Each stored value gets a version, computed by iVersionFunc(value) when given, a sequence number otherwise.
+#With a shared backend (see backends.py), stored values are also written there, as JSON, and entries missing or expired
+#locally are first looked up there: the cache then acts as a local copy of the cache shared by all the workers.
+class TTLCache(object):
+
+    def __init__(self, iTTL=1800, iMaxSize=256, iStaleTTL=0, iName='cache', iClock=time.time, iVersionFunc=None, iBackend=None, iKeepExpired=False):
+        self.name = iName
+        self.ttl = iTTL
+        self.maxSize = iMaxSize
+        self.staleTTL = iStaleTTL
+        self.keepExpired = iKeepExpired
+        self._clock = iClock
+        self._versionFunc = iVersionFunc
+        self.backend = iBackend
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._refreshing = {}
+        self.hits = 0
+        self.staleHits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refreshErrors = 0
+        self.evictions = 0
+        self.sharedHits = 0
+        self.backendErrors = 0
+        self.degradedHits = 0
+
+    def configure(self, iTTL=None, iMaxSize=None, iStaleTTL=None):
+        with self._lock:
+            if iTTL is not None:
+                self.ttl = iTTL
+            if iStaleTTL is not None:
+                self.staleTTL = iStaleTTL
+            if iMaxSize is not None:
+                self.maxSize = iMaxSize
+                self._evict()
+
+    #Return the cached value for iKey, calling iLoader() to compute it when missing or too old
+    def get(self, iKey, iLoader):
+        return self.getEntry(iKey, iLoader).value
+
+    #Same as get() but return the CacheEntry, to know the version and storage time of the value
+    def getEntry(self, iKey, iLoader):
+        if self.backend is not None:
+            self._loadShared(iKey)
+        aExpired = None
+        with self._lock:
+            aEntry = self._entries.get(iKey)
+            if aEntry is not None:
+                aAge = self._clock() - aEntry.storedAt
+                aTTL = self.ttl if aEntry.ttl is None else aEntry.ttl
+                if aAge < aTTL:
+                    self._entries.move_to_end(iKey)
+                    self.hits += 1
+                    return aEntry
+                if aAge < aTTL + self.staleTTL:
+                    self._entries.move_to_end(iKey)
+                    self.staleHits += 1
+                    self._scheduleRefresh(iKey, iLoader)
+                    return aEntry
+                if not self.keepExpired:
+                    del self._entries[iKey]
+                    aExpired, aEntry = aEntry, None
+            self.misses += 1
+
+        if aEntry is None:
+            return self._store(iKey, iLoader(), None, aExpired)
+        try:
+            aValue = iLoader()
+        except IOError as error:
+            logging.warning("{}: {} not reloaded, serving the value stored {:.0f}s ago: {}".format(self.name, iKey, self._clock() - aEntry.storedAt, error))
+            with self._lock:
+                self.degradedHits += 1
+            return aEntry
+        return self.set(iKey, aValue)
+
+    #Return the cached value for iKey if it is still fresh, or None. Never loads nor refreshes anything
+    def lookup(self, iKey):
+        if self.backend is not None:
+            self._loadShared(iKey)
+        with self._lock:
+            aEntry = self._entries.get(iKey)
+            if aEntry is not None:
+                aTTL = self.ttl if aEntry.ttl is None else aEntry.ttl
+                if self._clock() - aEntry.storedAt < aTTL:
+                    self._entries.move_to_end(iKey)
+                    self.hits += 1
+                    return aEntry.value
+                del self._entries[iKey]
+            self.misses += 1
+            return None
+
+    #Return the number of seconds before the entry for iKey expires (negative once expired), or None if it is not cached.
+    #With a shared backend, the shared entry is always read: another worker may have refreshed it before the local one expires
+    def expiresIn(self, iKey):
+        if self.backend is not None:
+            self._loadShared(iKey, iForce=True)
+        with self._lock:
+            aEntry = self._entries.get(iKey)
+            if aEntry is None:
+                return None
+            aTTL = self.ttl if aEntry.ttl is None else aEntry.ttl
+            return aEntry.storedAt + aTTL - self._clock()
+
+    #Return the cached value for iKey whatever its age, or None
+    def peek(self, iKey):
+        with self._lock:
+            aEntry = self._entries.get(iKey)
+            return None if aEntry is None else aEntry.value
+
+    #Store iValue, iTTL overrides the cache time to live for this entry only (e.g. short lived negative entries)
+    def set(self, iKey, iValue, iTTL=None):
+        return self._store(iKey, iValue, iTTL)
+
+    #iExpired is the entry just dropped for iKey, if any, so that an unchanged version keeps its modification time
+    def _store(self, iKey, iValue, iTTL, iExpired=None):
+        aVersion = None if self._versionFunc is None else self._versionFunc(iValue)
+        with self._lock:
+            if aVersion is None:
+                self._sequence += 1
+                aVersion = self._sequence
+            aPrevious = self._entries.get(iKey) or iExpired
+            aEntry = CacheEntry(iValue, self._clock(), aVersion, iTTL, None if aPrevious is None or aPrevious.version != aVersion else aPrevious.modifiedAt)
+            self._entries[iKey] = aEntry
+            self._entries.move_to_end(iKey)
+            self._evict()
+        if self.backend is not None:
+            self._storeShared(iKey, aEntry)
+        return aEntry
+
+    def delete(self, iKey):
+        with self._lock:
+            self._entries.pop(iKey, None)
+        if self.backend is not None:
+            try:
+                self.backend.delete(self._sharedKey(iKey))
+            except IOError as error:
+                self._backendFailed(error)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, iKey):
+        return iKey in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size':          len(self._entries),
+                'maxSize':       self.maxSize,
+                'ttl':           self.ttl,
+                'staleTTL':      self.staleTTL,
+                'hits':          self.hits,
+                'staleHits':     self.staleHits,
+                'misses':        self.misses,
+                'refreshes':     self.refreshes,
+                'refreshErrors': self.refreshErrors,
+                'evictions':     self.evictions,
+                'sharedHits':    self.sharedHits,
+                'backendErrors': self.backendErrors,
+                'degradedHits':  self.degradedHits,
+                'refreshing':    len(self._refreshing)
+                }
+
+    #Wait for the pending background refreshes, mostly useful for tests and clean shutdowns
+    def waitRefreshes(self, iTimeout=None):
+        with self._lock:
+            aThreads = list(self._refreshing.values())
+        for t in aThreads:
+            t.join(iTimeout)
+
+    def _sharedKey(self, iKey):
+        return '{}:{}'.format(self.name, iKey)
+
+    #A failing backend only costs its speed up: the cache keeps working locally
+    def _backendFailed(self, iError):
+        logging.warning("{}: cache backend error: {}".format(self.name, iError))
+        with self._lock:
+            self.backendErrors += 1
+
+    #Copy the shared entry for iKey in the local cache, when it is more recent than the local one.
+    #The backend is only read when the local entry is missing or expired, unless iForce
+    def _loadShared(self, iKey, iForce=False):
+        with self._lock:
+            aEntry = self._entries.get(iKey)
+            if not iForce and aEntry is not None and self._clock() - aEntry.storedAt < (self.ttl if aEntry.ttl is None else aEntry.ttl):
+                return
+        try:
+            aRaw = self.backend.get(self._sharedKey(iKey))
+        except IOError as error:
+            self._backendFailed(error)
+            return
+        if aRaw is None:
+            return
+        aShared = json.loads(aRaw)
+        with self._lock:
+            aEntry = self._entries.get(iKey)
+            if aEntry is None or aEntry.storedAt < aShared['storedAt']:
+                self._entries[iKey] = CacheEntry(aShared['value'], aShared['storedAt'], aShared['version'], aShared['ttl'], aShared.get('modifiedAt'))
+                self._entries.move_to_end(iKey)
+                self.sharedHits += 1
+                self._evict()
+
+    def _storeShared(self, iKey, iEntry):
+        aTTL = self.ttl if iEntry.ttl is None else iEntry.ttl
+        aRaw = json.dumps({'value': iEntry.value, 'storedAt': iEntry.storedAt, 'version': iEntry.version, 'ttl': iEntry.ttl,
+                           'modifiedAt': iEntry.modifiedAt})
+        try:
+            self.backend.set(self._sharedKey(iKey), aRaw, aTTL + self.staleTTL)
+        except IOError as error:
+            self._backendFailed(error)
+
+    #Must be called with the lock held
+    def _evict(self):
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    #Must be called with the lock held. Only one refresh per key runs at a time
+    def _scheduleRefresh(self, iKey, iLoader):
+        if iKey in self._refreshing:
+            return
+        aThread = threading.Thread(target=self._refresh, args=(iKey, iLoader), name='{}-refresh-{}'.format(self.name, iKey), daemon=True)
+        self._refreshing[iKey] = aThread
+        aThread.start()
+
+    def _refresh(self, iKey, iLoader):
+        try:
+            aValue = iLoader()
+            self.set(iKey, aValue)
+            with self._lock:
+                self.refreshes += 1
+        except Exception as error:
+            logging.warning("{}: background refresh of {} failed: {}".format(self.name, iKey, error))
+            with self._lock:
+                self.refreshErrors += 1
+        finally:
+            with self._lock:
+                self._refreshing.pop(iKey, None)
@@ -0,0 +1,165 @@
+#Local index of the cities already resolved through the meteofrance getLieux service
+
+import os
+import json
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+#Fields kept from each getLieux answer, in the order returned by getInseeCode
+CITY_FIELDS = ('indicatif', 'nom', 'codePostal', 'nomDept', 'numDept', 'pays')
+
+
+#Case and accent insensitive form of a city name, used as index key
+def normalizeCityName(iName):
+    aName = unicodedata.normalize('NFKD', ' '.join(iName.split()).lower())
+    return ''.join(c for c in aName if not unicodedata.combining(c))
+
+
+#Maps normalized city names to the list of getLieux entries they resolved to, and INSEE codes to their city.
+#The full entry list is kept per name so that getInseeCode applies exactly the same ambiguity rules as with a live answer.
+#Both maps are bounded and evicted in LRU order.
+#Names getLieux did not recognize (empty list) are remembered apart, for iUnknownTTL seconds and at most iMaxUnknown of them,
+#so that scanners and typos cannot push real cities out and a transient empty answer is soon asked again. They are neither
+#shared nor saved.
+#With a shared backend (see backends.py), resolved names are also written there and names unknown locally are looked up there.
+class CityIndex(object):
+
+    #How long a resolution is kept in the shared backend, in seconds
+    SHARED_TTL = 30*24*3600
+
+    def __init__(self, iMaxSize=4096, iBackend=None, iUnknownTTL=600, iMaxUnknown=1024, iClock=time.time):
+        self.maxSize = iMaxSize
+        self.backend = iBackend
+        self.unknownTTL = iUnknownTTL
+        self.maxUnknown = iMaxUnknown
+        self._clock = iClock
+        self._lock = threading.Lock()
+        self._byName = OrderedDict()
+        self._byInsee = OrderedDict()
+        self._unknown = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.sharedHits = 0
+        self.backendErrors = 0
+
+    #Return the list of entries known for iName, or None if the name was never resolved
+    def lookup(self, iName):
+        aKey = normalizeCityName(iName)
+        with self._lock:
+            aEntries = self._byName.get(aKey)
+            if aEntries is not None:
+                self._byName.move_to_end(aKey)
+                self.hits += 1
+                return aEntries
+            aExpiresAt = self._unknown.get(aKey)
+            if aExpiresAt is not None:
+                if aExpiresAt > self._clock():
+                    self.hits += 1
+                    return []
+                del self._unknown[aKey]
+        aEntries = self._lookupShared(aKey)
+        with self._lock:
+            if aEntries is None:
+                self.misses += 1
+            else:
+                self.sharedHits += 1
+        return aEntries
+
+    def _lookupShared(self, iKey):
+        if self.backend is None:
+            return None
+        try:
+            aRaw = self.backend.get('city:' + iKey)
+        except IOError as error:
+            logging.warning("City index backend error: {}".format(error))
+            self.backendErrors += 1
+            return None
+        aEntries = None if aRaw is None else json.loads(aRaw)
+        #Unknown names written by older versions are ignored
+        if not aEntries:
+            return None
+        return self._addLocal(iKey, aEntries)
+
+    #Return [indicatif, nom, codePostal, nomDept, numDept, pays] for the INSEE code, or None
+    def lookupInsee(self, iInseeCode):
+        with self._lock:
+            aCity = self._byInsee.get(iInseeCode)
+            return None if aCity is None else list(aCity)
+
+    #Record the getLieux entries (data['result']['france']) answered for iName
+    def add(self, iName, iEntries):
+        aKey = normalizeCityName(iName)
+        if not iEntries:
+            with self._lock:
+                self._unknown[aKey] = self._clock() + self.unknownTTL
+                self._unknown.move_to_end(aKey)
+                while len(self._unknown) > self.maxUnknown:
+                    self._unknown.popitem(last=False)
+            return []
+        aEntries = self._addLocal(aKey, [{f: e[f] for f in CITY_FIELDS} for e in iEntries])
+        if self.backend is not None:
+            try:
+                self.backend.set('city:' + aKey, json.dumps(aEntries, ensure_ascii=False), CityIndex.SHARED_TTL)
+            except IOError as error:
+                logging.warning("City index backend error: {}".format(error))
+                self.backendErrors += 1
+        return aEntries
+
+    def _addLocal(self, iKey, iEntries):
+        with self._lock:
+            self._byName[iKey] = iEntries
+            self._byName.move_to_end(iKey)
+            for e in iEntries:
+                self._byInsee[e['indicatif']] = tuple(e[f] for f in CITY_FIELDS)
+                self._byInsee.move_to_end(e['indicatif'])
+            while len(self._byName) > self.maxSize:
+                self._byName.popitem(last=False)
+            while len(self._byInsee) > self.maxSize:
+                self._byInsee.popitem(last=False)
+        return iEntries
+
+    def __len__(self):
+        return len(self._byName)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'names':         len(self._byName),
+                'cities':        len(self._byInsee),
+                'unknownNames':  len(self._unknown),
+                'maxSize':       self.maxSize,
+                'hits':          self.hits,
+                'misses':        self.misses,
+                'sharedHits':    self.sharedHits,
+                'backendErrors': self.backendErrors
+                }
+
+    #Load a snapshot written by save(), entries already known are kept. Unknown names of older snapshots are skipped
+    def load(self, iPath):
+        try:
+            with open(iPath, 'r', encoding='utf-8') as f:
+                aSnapshot = json.load(f)
+        except (IOError, ValueError) as error:
+            logging.debug("City index snapshot {} not loaded: {}".format(iPath, error))
+            return 0
+        aNames = {k: v for k, v in aSnapshot.get('names', {}).items() if v}
+        for aName, aEntries in aNames.items():
+            self.add(aName, aEntries)
+        return len(aNames)
+
+    #Write the index to iPath, through a temporary file so that a concurrent load never reads a partial snapshot
+    def save(self, iPath):
+        with self._lock:
+            aSnapshot = {'names': dict(self._byName)}
+        aTmpPath = '{}.{}.tmp'.format(iPath, os.getpid())
+        try:
+            with open(aTmpPath, 'w', encoding='utf-8') as f:
+                json.dump(aSnapshot, f, ensure_ascii=False)
+            os.replace(aTmpPath, iPath)
+        except IOError as error:
+            logging.warning("City index snapshot {} not saved: {}".format(iPath, error))
+            return False
+        return True
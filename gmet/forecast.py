@@ -0,0 +1,121 @@
+#Normalized view of a meteofrance getDetail answer, built in a single pass over its resumes, previsions and previsions48h sections.
+#Both the terminal and the web renderers work from it instead of probing the upstream dicts day by day.
+
+#Periods of a day, in display order
+PERIODS = ('matin', 'midi', 'soir', 'nuit')
+
+#Period each 3 hours time range of previsions48h belongs to, with the offset of the day of that period compared to
+#the day of the time range ('1_01-04' is part of the night of day 0), and its display rank within the period
+TIMERANGES = {
+    '07-10': ('matin', 0, 0),
+    '10-13': ('matin', 0, 1),
+    '13-16': ('midi', 0, 0),
+    '16-19': ('midi', 0, 1),
+    '19-22': ('soir', 0, 0),
+    '22-01': ('nuit', 0, 0),
+    '01-04': ('nuit', -1, 1),
+    '04-07': ('nuit', -1, 2)
+    }
+
+
+#3 hours forecast from previsions48h
+class TimeRange(object):
+    __slots__ = ('timerange', 'rank', 'description', 'temperatureMin', 'temperatureMax', 'vitesseVent', 'probaPluie')
+
+    def __init__(self, iTimerange, iRank, iData):
+        self.timerange = iTimerange
+        self.rank = iRank
+        self.description = iData['description']
+        self.temperatureMin = iData['temperatureMin']
+        self.temperatureMax = iData['temperatureMax']
+        self.vitesseVent = iData['vitesseVent']
+        self.probaPluie = iData['probaPluie']
+
+
+#Forecast for a period of the day from previsions, with its 3 hours details when available
+class Period(object):
+    __slots__ = ('name', 'description', 'temperature', 'vitesseVent', 'timeranges')
+
+    def __init__(self, iName, iData):
+        self.name = iName
+        self.description = iData['description']
+        self.temperature = iData['temperatureCarte']
+        self.vitesseVent = iData['vitesseVent']
+        self.timeranges = []
+
+
+#Forecast for a day: the daily summary from resumes, if any, and its periods
+class Day(object):
+    __slots__ = ('index', 'hasResume', 'date', 'description', 'temperatureMin', 'temperatureMax', 'periods')
+
+    def __init__(self, iIndex):
+        self.index = iIndex
+        self.hasResume = False
+        self.date = None
+        self.description = None
+        self.temperatureMin = None
+        self.temperatureMax = None
+        self.periods = {}
+
+    def setResume(self, iData):
+        self.hasResume = True
+        self.date = iData['date']
+        self.description = iData['description']
+        self.temperatureMin = iData['temperatureMin']
+        self.temperatureMax = iData['temperatureMax']
+
+
+#Whole forecast: the city and its days sorted by index. Day.periods is a list in PERIODS order once normalized
+class Forecast(object):
+    __slots__ = ('ville', 'days')
+
+    def __init__(self, iVille, iDays):
+        self.ville = iVille
+        self.days = iDays
+
+
+#Split a key like '3_matin' or '0_07-10' into (3, 'matin'), or None when it does not follow that pattern
+def parseKey(iKey):
+    aIndex, aSeparator, aSuffix = iKey.partition('_')
+    if not aSeparator or not aIndex.isdigit():
+        return None
+    return int(aIndex), aSuffix
+
+def normalizeForecast(iData):
+    aResult = iData['result']
+    aDays = {}
+
+    for aKey, aValue in aResult['resumes'].items():
+        aParsed = parseKey(aKey)
+        if aParsed is not None and aParsed[1] == 'resume':
+            aDay = aDays.get(aParsed[0])
+            if aDay is None:
+                aDay = aDays[aParsed[0]] = Day(aParsed[0])
+            aDay.setResume(aValue)
+
+    for aKey, aValue in aResult['previsions'].items():
+        aParsed = parseKey(aKey)
+        if aParsed is not None and aParsed[1] in PERIODS:
+            aDay = aDays.get(aParsed[0])
+            if aDay is None:
+                aDay = aDays[aParsed[0]] = Day(aParsed[0])
+            aDay.periods[aParsed[1]] = Period(aParsed[1], aValue)
+
+    #Time ranges are only kept when the period they refine exists
+    for aKey, aValue in aResult['previsions48h'].items():
+        aParsed = parseKey(aKey)
+        if aParsed is None or aParsed[1] not in TIMERANGES:
+            continue
+        aPeriodName, aOffset, aRank = TIMERANGES[aParsed[1]]
+        aDay = aDays.get(aParsed[0] + aOffset)
+        if aDay is not None and aPeriodName in aDay.periods:
+            aDay.periods[aPeriodName].timeranges.append(TimeRange(aParsed[1], aRank, aValue))
+
+    aSortedDays = [aDays[i] for i in sorted(aDays)]
+    for aDay in aSortedDays:
+        aDay.periods = [aDay.periods[p] for p in PERIODS if p in aDay.periods]
+        for aPeriod in aDay.periods:
+            if len(aPeriod.timeranges) > 1:
+                aPeriod.timeranges.sort(key=lambda r: r.rank)
+
+    return Forecast(aResult['ville'], aSortedDays)
@@ -1,5 +1,7 @@
-#Can be started with gunicorn --bind=0.0.0.0 --timeout 600 gmet:app
+#Can be started with gunicorn --bind=0.0.0.0 --timeout 60 gmet:app
 
+#Modules only needed by the web server, the HTML output, the batch mode or the background refresh (jinja2, jproperties,
+#concurrent.futures, subprocess, ipaddress, hashlib) are imported where they are used, to keep the command line fast to start
 import os
 import sys
 import re
@@ -7,16 +9,135 @@ import json
 import time
 import datetime
 import argparse
+import functools
+import atexit
 import logging
-import locale
-from urllib.request import urlopen
-from jinja2 import Environment, PackageLoader, select_autoescape
-from jproperties import Properties
-import pprint
-
-
-# Request Cache
-cacheRequests = {}
+from gmet.cache import TTLCache
+from gmet.memorybackend import MemoryBackend
+from gmet.topk import FrequentTracker
+from gmet.cityindex import CityIndex
+from gmet.forecast import normalizeForecast
+from gmet.upstream import UpstreamClient, CircuitBreaker, isHostDown
+from gmet.scheduler import PrefetchScheduler, RateBudget
+from gmet.snapshot import SnapshotStore
+from gmet.metrics import MetricsRegistry, RequestProfiler
+
+
+# Cache Backend, holding the request counters and, when shared between processes, the forecasts and city resolutions
+# It is in-process by default, see configureBackend
+cacheBackend = MemoryBackend()
+
+# Request Counters, a bounded table of the most requested cities. FREQUENT_TOP of them are listed in the web page
+REQUEST_COUNTERS = 'requests'
+FREQUENT_CAPACITY = 256
+FREQUENT_HALF_LIFE = 7*24*3600
+FREQUENT_TOP = 47
+requestTracker = FrequentTracker(cacheBackend, REQUEST_COUNTERS, iCapacity=FREQUENT_CAPACITY, iHalfLife=FREQUENT_HALF_LIFE)
+
+#Configuration file, mounted from the ConfigMap in the kubernetes deployment, and its last loaded content
+CONFIG_FILE = 'config/config.ini'
+configMtime = None
+configValues = {}
+
+#Upstream services, overridable from the environment to run against a local stand-in (see tests/upstream_standin.py)
+IPINFO_URL = os.environ.get('GMET_IPINFO_URL', 'http://ipinfo.io')
+METEOFRANCE_URL = os.environ.get('GMET_METEOFRANCE_URL', 'http://ws.meteofrance.com/ws')
+
+#Upstream Client, shared by all the calls to ipinfo.io and ws.meteofrance.com. Timeouts are in seconds.
+#Failed calls are retried UPSTREAM_MAX_RETRIES times, a host failing UPSTREAM_BREAKER_FAILURES times in a row is not called
+#for UPSTREAM_BREAKER_RESET seconds, and all the upstream calls of a web request must end within REQUEST_DEADLINE
+UPSTREAM_CONNECT_TIMEOUT = 3
+UPSTREAM_READ_TIMEOUT = 10
+UPSTREAM_MAX_CONNECTIONS = 4
+UPSTREAM_MAX_RETRIES = 2
+UPSTREAM_BACKOFF = 0.1
+UPSTREAM_BREAKER_FAILURES = 5
+UPSTREAM_BREAKER_RESET = 30
+REQUEST_DEADLINE = 8
+upstreamClient = UpstreamClient(iMaxConnectionsPerHost=UPSTREAM_MAX_CONNECTIONS, iConnectTimeout=UPSTREAM_CONNECT_TIMEOUT, iReadTimeout=UPSTREAM_READ_TIMEOUT,
+                                iMaxRetries=UPSTREAM_MAX_RETRIES, iBackoff=UPSTREAM_BACKOFF, iBreakerFailures=UPSTREAM_BREAKER_FAILURES, iBreakerReset=UPSTREAM_BREAKER_RESET)
+requestDeadline = REQUEST_DEADLINE
+
+#Forecast Cache, keyed by INSEE code. Values below are defaults, overridable in the configuration file.
+#Expired forecasts are kept, until evicted, to be served when Meteo France is not reachable
+FORECAST_CACHE_TTL = 1800
+FORECAST_CACHE_STALE_TTL = 6*3600
+FORECAST_CACHE_SIZE = 512
+
+#Version of a forecast, a digest of the upstream answer: identical answers get the same version in every process
+def getForecastVersion(iData):
+    import hashlib
+    return hashlib.sha1(json.dumps(iData, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+forecastCache = TTLCache(iTTL=FORECAST_CACHE_TTL, iMaxSize=FORECAST_CACHE_SIZE, iStaleTTL=FORECAST_CACHE_STALE_TTL, iName='forecast', iVersionFunc=getForecastVersion, iKeepExpired=True)
+serverConfigured = False
+
+#Geolocation Cache, keyed by client IP and by network prefix. Failed lookups are cached for a shorter time
+GEOLOCATION_CACHE_TTL = 24*3600
+GEOLOCATION_CACHE_NEGATIVE_TTL = 300
+GEOLOCATION_CACHE_SIZE = 8192
+GEOLOCATION_PREFIX_IPV4 = 24
+GEOLOCATION_PREFIX_IPV6 = 48
+GEOLOCATION_FAILED = object()
+geolocationCache = TTLCache(iTTL=GEOLOCATION_CACHE_TTL, iMaxSize=GEOLOCATION_CACHE_SIZE, iName='geolocation')
+
+#Web page Cache, keyed by (INSEE code, forecast version, frequents list) so that identical pages are not rendered again
+PAGE_CACHE_SIZE = 256
+pageCache = TTLCache(iTTL=FORECAST_CACHE_TTL, iMaxSize=PAGE_CACHE_SIZE, iName='page')
+
+#Jinja environment and template, built once per process. Templates are only checked for changes in development mode
+TEMPLATE_NAME = 'output_template.html.jinja'
+TEMPLATE_AUTO_RELOAD = os.environ.get('FLASK_ENV') == 'development'
+templateEnvironment = None
+outputTemplate = None
+
+#Prefetch Scheduler, keeps the favorites and the most requested cities warm in the forecast cache. Started by the web server only
+PREFETCH_TOP = 10
+PREFETCH_INTERVAL = 60
+PREFETCH_RATE = 30
+prefetchScheduler = None
+
+#City Index, resolves city names without calling getLieux once they have been seen
+CITY_INDEX_SIZE = 4096
+CITY_INDEX_UNKNOWN_TTL = 600
+cityIndex = CityIndex(iMaxSize=CITY_INDEX_SIZE, iUnknownTTL=CITY_INDEX_UNKNOWN_TTL)
+
+#Batch mode: number of cities fetched in parallel by default, and at most per web request
+BATCH_JOBS = 8
+BATCH_MAX_CITIES = 100
+INSEE_CODE = re.compile(r'\d{6}')
+
+#Command line snapshots of the last answers, see snapshot.py. With --fast, older ones are refreshed in background
+SNAPSHOT_REFRESH_AGE = 600
+snapshotStore = None
+
+#Default refresh interval of --watch, in seconds
+WATCH_INTERVAL = 300
+
+#Metrics of the web server, see metrics.py and the /metrics route. Disabled, and nearly free, until configureServer enables them.
+#Cache and upstream statistics are counted anyway, they are read from a single getCacheStats when /metrics is scraped
+METRICS_PROFILE_KEEP = 10
+metricsRegistry = MetricsRegistry(iSnapshot=lambda: getCacheStats())
+stageSeconds = metricsRegistry.histogram('gmet_stage_seconds', 'Time spent in each stage of a request', ('stage',))
+requestSeconds = metricsRegistry.histogram('gmet_request_seconds', 'Time to answer a request, up to its first byte', ('endpoint',))
+requestsTotal = metricsRegistry.counter('gmet_requests_total', 'Requests answered', ('endpoint', 'status'))
+requestsInFlight = metricsRegistry.gauge('gmet_requests_in_flight', 'Requests being answered')
+metricsRegistry.collected('gmet_cache_hits_total', 'Cache hits, stale and shared ones included', ('cache',), 'counter', lambda s: getCacheCounters(s, 0))
+metricsRegistry.collected('gmet_cache_misses_total', 'Cache misses', ('cache',), 'counter', lambda s: getCacheCounters(s, 1))
+metricsRegistry.collected('gmet_cache_hit_ratio', 'Hits over lookups of each cache since the start', ('cache',), 'gauge', lambda s: getCacheCounters(s, 2))
+metricsRegistry.collected('gmet_upstream_requests_total', 'Requests sent to the upstream services', ('host',), 'counter', lambda s: getUpstreamCounters(s, 'requests'))
+metricsRegistry.collected('gmet_upstream_errors_total', 'Upstream requests failed on a connection error', ('host',), 'counter', lambda s: getUpstreamCounters(s, 'errors'))
+metricsRegistry.collected('gmet_upstream_http_errors_total', 'Upstream requests answered with an HTTP error status', ('host',), 'counter', lambda s: getUpstreamCounters(s, 'httpErrors'))
+metricsRegistry.collected('gmet_upstream_timeouts_total', 'Upstream requests timed out', ('host',), 'counter', lambda s: getUpstreamCounters(s, 'timeouts'))
+metricsRegistry.collected('gmet_upstream_rejected_total', 'Upstream calls rejected by an open circuit breaker', ('host',), 'counter', lambda s: getUpstreamCounters(s, 'rejected'))
+metricsRegistry.collected('gmet_upstream_breaker_state', 'Circuit breaker of each upstream host: 0 closed, 1 half-open, 2 open (degraded mode)', ('host',), 'gauge',
+                          lambda s: {k: CircuitBreaker.STATES.index(v) for k, v in getUpstreamCounters(s, 'breaker').items()})
+metricsRegistry.collected('gmet_upstream_retries_total', 'Upstream calls retried after a failure', (), 'counter', lambda s: {(): s['upstream']['retried']})
+metricsRegistry.collected('gmet_cache_degraded_hits_total', 'Expired values served because reloading them failed', ('cache',), 'counter',
+                          lambda s: {('forecast',): s['forecast']['degradedHits']})
+metricsRegistry.collected('gmet_cache_backend_errors_total', 'Cache backend calls failed, the caches then work locally', ('cache',), 'counter',
+                          lambda s: {(aName,): s[aName]['backendErrors'] for aName in ('forecast', 'cities', 'frequent')})
+requestProfiler = RequestProfiler(iKeep=METRICS_PROFILE_KEEP)
 
 #Color definitions
 CFLASH =  '\033[7;1m' # White Background, Bold black Text
@@ -40,18 +161,24 @@ def parse(iArgs=None) :
     parser.add_argument('--log', '-l', metavar='log_level', dest='loglevel', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], default='INFO', help='set the log level DEBUG, INFO, WARNING, ERROR or CRITICAL')
     parser.add_argument('--html', dest='html_output', default=False, action='store_true', help='send output to the browser (chrome)')
     parser.add_argument('--noterm', dest='terminal_output', default=True, action='store_false', help='do not write output to stdout')
+    parser.add_argument('--cities', dest='cities', nargs='+', metavar='CITY', help='several cities fetched concurrently, each given as a name, an Insee Code, or name,inseecode in case of ambiguity')
+    parser.add_argument('--file', '-f', dest='file', metavar='FILE', help='file with one city per line, in the same forms as --cities, lines starting with # are ignored')
+    parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=BATCH_JOBS, help='number of cities fetched in parallel with --cities or --file')
+    parser.add_argument('--json', dest='json_output', default=False, action='store_true', help='write the forecast as JSON, one line per city, instead of the terminal view')
+    parser.add_argument('--fast', '-F', dest='fast', default=False, action='store_true', help='print the last known forecast immediately, without network, and refresh it in background')
+    parser.add_argument('--watch', '-w', dest='watch', type=float, nargs='?', const=WATCH_INTERVAL, metavar='SECONDS', help='keep the forecast on screen and refresh it every SECONDS (default {}), redrawing only the lines that changed'.format(WATCH_INTERVAL))
+    parser.add_argument('--refresh-snapshot', dest='refresh_snapshot', default=False, action='store_true', help=argparse.SUPPRESS)
     parser.add_argument('--version', '-v', action='version', version='%(prog)s 0.9')
     return parser.parse_args(iArgs)
 
 
-#function to localize the computer
-def localize(iIP=None) :
-    url = 'http://ipinfo.io'
-    if iIP is not None and not iIP.startswith("127") and not iIP.startswith("192.168") and not iIP.startswith("172.16"):
+#function to query ipinfo.io, localizes the computer itself when iIP is None
+def getLocationFromIpinfoAPI(iIP=None) :
+    url = IPINFO_URL
+    if iIP is not None:
         url = url+'/'+iIP
     logging.debug(url)
-    response = urlopen(url)
-    data = json.load(response)
+    data = upstreamClient.getJson(url)
 
     # d = dict()
     # d['ip'] = data['ip']
@@ -61,14 +188,65 @@ def localize(iIP=None) :
 
     return data
 
+#Cache keys for a client IP: the address itself and its network prefix, so that neighbours share the lookup.
+#Local addresses (and no address) localize the server itself, other non routable addresses are bogons decided locally
+def getGeolocationKeys(iIP):
+    import ipaddress
+    if iIP is None or iIP.startswith("127") or iIP.startswith("192.168") or iIP.startswith("172.16"):
+        return None, ['self']
+    try:
+        aAddress = ipaddress.ip_address(iIP)
+    except ValueError:
+        return iIP, []
+    if not aAddress.is_global:
+        return iIP, []
+    aPrefix = GEOLOCATION_PREFIX_IPV4 if aAddress.version == 4 else GEOLOCATION_PREFIX_IPV6
+    return iIP, [iIP, str(ipaddress.ip_network('{}/{}'.format(iIP, aPrefix), strict=False))]
+
+#function to localize the computer, or the client IP, through the geolocation cache
+@stageSeconds.timed('localize')
+def localize(iIP=None) :
+    aIP, aKeys = getGeolocationKeys(iIP)
+    if not aKeys:
+        logging.debug("Bogon IP address {}, not sent to ipinfo".format(iIP))
+        return {'ip': iIP, 'bogon': True}
+
+    for aKey in aKeys:
+        data = geolocationCache.lookup(aKey)
+        if data is GEOLOCATION_FAILED:
+            raise IOError('Geolocation of {} failed recently, not retried yet'.format(iIP))
+        if data is not None:
+            data = dict(data)
+            if aIP is not None:
+                data['ip'] = aIP
+            return data
+
+    try:
+        data = getLocationFromIpinfoAPI(aIP)
+    except Exception:
+        for aKey in aKeys:
+            geolocationCache.set(aKey, GEOLOCATION_FAILED, GEOLOCATION_CACHE_NEGATIVE_TTL)
+        raise
+    for aKey in aKeys:
+        geolocationCache.set(aKey, data)
+    return dict(data)
+
+#function to query the meteofrance getLieux service, returns the list of matching cities
+def getLieuxFromMeteoFranceAPI(iCityName):
+    url = METEOFRANCE_URL + '/getLieux/' + iCityName + '.json'
+    data = upstreamClient.getJson(url)
+    logging.debug("meteofrance getLieux API answer\n" + json.dumps(data))
+    return data['result']['france']
+
 #function to get INSEE code of the city
+#Cities already resolved are answered from the local city index, only new names go to the getLieux service
 #TODO: error management vie exception
+@stageSeconds.timed('getInseeCode')
 def getInseeCode(iCityName, iInseeCode=None):
-    url = 'http://ws.meteofrance.com/ws/getLieux/' + iCityName + '.json'
-    response = urlopen(url)
-    data = json.load(response)
-    logging.debug("meteofrance getLieux API answer\n" + json.dumps(data))
-    if ( len(data['result']['france']) == 0):
+    aEntries = cityIndex.lookup(iCityName)
+    if aEntries is None:
+        aEntries = cityIndex.add(iCityName, getLieuxFromMeteoFranceAPI(iCityName))
+    if ( len(aEntries) == 0):
         logging.error('Unknown Input City name: '+iCityName)
         raise ValueError('Unknown Input City name: '+iCityName)
     else:
@@ -77,7 +255,7 @@ def getInseeCode(iCityName, iInseeCode=None):
         k=None
         candidate_list = {}
 
-        for e in data['result']['france']:
+        for e in aEntries:
             #Regroup by code postal to see if there is only one at the end, works well for antibes. Also use iInseeCode to filter out those not wished
             if (e['codePostal'] not in candidate_list) or (e['nom']==iCityName):
                 if iInseeCode==None or e['indicatif'] == iInseeCode:
@@ -98,184 +276,353 @@ def getInseeCode(iCityName, iInseeCode=None):
         return candidate_list[k]
 
 #function to get meteo data from MeteoFrance
+@stageSeconds.timed('getDataFromMeteoFranceAPI')
 def getDataFromMeteoFranceAPI( iCityInseeCode ):
     #Biot url: http://ws.meteofrance.com/ws/getDetail/france/060180.json
-    url = 'http://ws.meteofrance.com/ws/getDetail/france/' + iCityInseeCode + '.json'
-    response = urlopen(url)
-    data = json.load(response)
+    url = METEOFRANCE_URL + '/getDetail/france/' + iCityInseeCode + '.json'
+    data = upstreamClient.getJson(url)
     logging.debug("meteofrance getDetail API answer\n" + json.dumps(data))
     # Uncomment the below to dump the raw data fom Meteo France
     #pp = pprint.PrettyPrinter(indent=2)
     #pp.pprint(data)
     return data
 
-#Build the right output screen with details at day level, period level, and range of our level, refining data when available
-def formatOutputForTerminal(iConfig, iData):
-    #Print header
-    print(CFLASH + '-- Meteo forecast -- {} ({} - {}) --'.format(iData['result']['ville']['nom'],iData['result']['ville']['numDept'],iData['result']['ville']['pays']) + '                        ' + CEND)
+#function to get meteo data through the forecast cache: a fresh copy is served as is, a stale one is served and refreshed in background
+def getForecast( iCityInseeCode ):
+    return getForecastEntry(iCityInseeCode).value
+
+#Same as getForecast but return the cache entry, giving the version of the forecast along with the data
+def getForecastEntry( iCityInseeCode ):
+    return forecastCache.getEntry(iCityInseeCode, lambda: getDataFromMeteoFranceAPI(iCityInseeCode))
+
+#Words deciding the color of a day: BLUE if it contains pluie or averse, ORANGE if it contains soleil (even with rain), GREEN otherwise
+DESCRIPTION_WORDS = re.compile('pluie|averse|soleil')
+
+#Descriptions come from a small vocabulary, so each distinct one is classified only once
+@functools.lru_cache(maxsize=256)
+def getDescriptionColor(iDescription):
+    aWords = set(DESCRIPTION_WORDS.findall(iDescription.lower()))
+    if 'soleil' in aWords:
+        return CORANGE
+    if aWords:
+        return CBLUE
+    return CGREEN
+
+#Build the right output screen with details at day level, period level, and range of our level, refining data when available, as lines without line endings
+def renderTerminal(iConfig, iData):
+    aForecast = normalizeForecast(iData)
+    aLines = [CFLASH + '-- Meteo forecast -- {} ({} - {}) --'.format(aForecast.ville['nom'],aForecast.ville['numDept'],aForecast.ville['pays']) + '                        ' + CEND]
 
     #Define range of date to display base on command line inputs
     if not iConfig.offset:
         iConfig.offset.append(0)
         if datetime.datetime.now().hour>16:
             iConfig.offset.append(1)
-    myRange = range(min(iConfig.offset), max(iConfig.offset)+1)
-    
+    myDays = [d for d in aForecast.days if min(iConfig.offset) <= d.index <= max(iConfig.offset)]
+
     displayCondensed = False
     if iConfig.summary:
-        #Display the 10 days of daily prevision in resumes section
-        myRange = range(0, 100)
+        #Display all the days of daily prevision in resumes section
+        myDays = aForecast.days
         if iConfig.summary > 1:
             displayCondensed = True
 
-    #Do the actual display
-    for i in myRange:
-        keyResumes = str(i)+'_resume'
-        if keyResumes in iData['result']['resumes']:
-            timeString = time.strftime("%a-%d%b", time.gmtime(iData['result']['resumes'][keyResumes]['date'] / 1000))
-            #TODO: Change the color Orange/Blue/Green based on the prevision (sun or rain) available in variable iData['result']['resumes'][keyResumes]['description']
-            #BLUE if contains pluie or averse
-            #ORANGE if contains soleil or ??
-            #GREEN otherwise
-            COLOR = CGREEN
-            if re.search('pluie', iData['result']['resumes'][keyResumes]['description'].lower()):
-                COLOR = CBLUE
-            if re.search('averse', iData['result']['resumes'][keyResumes]['description'].lower()):
-                COLOR = CBLUE
-            if re.search('soleil', iData['result']['resumes'][keyResumes]['description'].lower()):
-                COLOR = CORANGE
-            print(COLOR + "{} | {:<17} | T: {:>2}-{:>2}".format(timeString, iData['result']['resumes'][keyResumes]['description'], iData['result']['resumes'][keyResumes]['temperatureMin'], iData['result']['resumes'][keyResumes]['temperatureMax']) + CEND)
+    for aDay in myDays:
+        if aDay.hasResume:
+            timeString = time.strftime("%a-%d%b", time.gmtime(aDay.date / 1000))
+            aLines.append(getDescriptionColor(aDay.description) + "{} | {:<17} | T: {:>2}-{:>2}".format(timeString, aDay.description, aDay.temperatureMin, aDay.temperatureMax) + CEND)
 
         # This boolean test if the display should be a super condensed one keeping only values at day level
         if not displayCondensed:
-            #Then, display the prevision "by range matin, midi, soir, nuit" in previsions section
-            for r in ['matin', 'midi', 'soir', 'nuit']:
-                keyPrevisions = str(i)+'_'+r
-                if keyPrevisions in iData['result']['previsions']:
-                    detailDisplayed = False
-                    l = []
-                    if r == 'matin':
-                        l = [str(i) + '_' + x for x in ['07-10', '10-13']]
-                    if r == 'midi':
-                        l = [str(i) + '_' + x for x in ['13-16', '16-19']]
-                    if r == 'soir':
-                        l = [str(i) + '_' + x for x in ['19-22']]
-                    if r == 'nuit':
-                        l = [str(i) + '_' + x for x in ['22-01']] + [str(i+1) + '_' + x for x in ['01-04', '04-07']]                
-                
-                    for keyPrevisions48h in l:
-                        if keyPrevisions48h in iData['result']['previsions48h']:
-                            print(' * {:>5}h | {:<17} | T: {:>2}-{:>2} | V: {:<3} Pluie?: {:>2}%'.format(keyPrevisions48h[2:], iData['result']['previsions48h'][keyPrevisions48h]['description'], iData['result']['previsions48h'][keyPrevisions48h]['temperatureMin'], iData['result']['previsions48h'][keyPrevisions48h]['temperatureMax'], iData['result']['previsions48h'][keyPrevisions48h]['vitesseVent'], iData['result']['previsions48h'][keyPrevisions48h]['probaPluie']))
-                            detailDisplayed = True
-
-                    if not detailDisplayed:
-                        print(' -> {:>5} | {:<17} | T: {:^6}| V: {:<3}'.format(r, iData['result']['previsions'][keyPrevisions]['description'], iData['result']['previsions'][keyPrevisions]['temperatureCarte'], iData['result']['previsions'][keyPrevisions]['vitesseVent']))
-
-#Build the right output screen with details at day level, period level, and range of our level, refining data when available
-def buildCleanObject(iConfig, iData):
+            #Then, display the prevision "by range matin, midi, soir, nuit", with the 3 hours details when available
+            for aPeriod in aDay.periods:
+                for r in aPeriod.timeranges:
+                    aLines.append(' * {:>5}h | {:<17} | T: {:>2}-{:>2} | V: {:<3} Pluie?: {:>2}%'.format(r.timerange, r.description, r.temperatureMin, r.temperatureMax, r.vitesseVent, r.probaPluie))
+
+                if not aPeriod.timeranges:
+                    aLines.append(' -> {:>5} | {:<17} | T: {:^6}| V: {:<3}'.format(aPeriod.name, aPeriod.description, aPeriod.temperature, aPeriod.vitesseVent))
+    return aLines
+
+#Write the whole terminal view with a single write, instead of one print per line
+def formatOutputForTerminal(iConfig, iData, iOutput=None):
+    aOutput = iOutput or sys.stdout
+    aOutput.write('\n'.join(renderTerminal(iConfig, iData)) + '\n')
+    aOutput.flush()
+
+#ANSI sequences turning the screen showing iPrevious lines into iLines: only the changed lines are rewritten,
+#the whole screen is cleared on the first draw (iPrevious is None)
+def formatScreenUpdate(iPrevious, iLines):
+    if iPrevious is None:
+        return '\033[H\033[2J' + '\n'.join(iLines) + '\n'
+    aParts = []
+    for aRow in range(max(len(iPrevious), len(iLines))):
+        aLine = iLines[aRow] if aRow < len(iLines) else ''
+        if aRow >= len(iPrevious) or aLine != iPrevious[aRow]:
+            aParts.append('\033[{};1H{}\033[K'.format(aRow + 1, aLine))
+    #Leave the cursor below the forecast
+    aParts.append('\033[{};1H'.format(len(iLines) + 1))
+    return ''.join(aParts)
+
+#Keep the forecast on screen, fetched again every iArgs.watch seconds, until interrupted (or iCount refreshes, for tests)
+def executeWatch(iArgs, iCityInseeCode, iData, iCount=None):
+    aScreen = None
+    aRefreshes = 0
+    try:
+        while True:
+            aLines = renderTerminal(iArgs, iData)
+            aLines.append('-- Updated at {}, every {}s, Ctrl-C to quit --'.format(time.strftime("%H:%M:%S"), iArgs.watch))
+            sys.stdout.write(formatScreenUpdate(aScreen, aLines))
+            sys.stdout.flush()
+            aScreen = aLines
+            if iCount is not None and aRefreshes >= iCount:
+                return
+            aRefreshes += 1
+            time.sleep(iArgs.watch)
+            try:
+                iData = getDataFromMeteoFranceAPI(iCityInseeCode)
+                openSnapshotStore().saveForecast(iCityInseeCode, iData)
+            except IOError as error:
+                logging.debug("Watch: forecast not refreshed: {}".format(error))
+    except KeyboardInterrupt:
+        pass
+
+#French abbreviated day and month names, as given by strftime %a and %b in the fr_FR locale
+FRENCH_DAYS = ['lun.', 'mar.', 'mer.', 'jeu.', 'ven.', 'sam.', 'dim.']
+FRENCH_MONTHS = ['janv.', 'févr.', 'mars', 'avril', 'mai', 'juin', 'juil.', 'août', 'sept.', 'oct.', 'nov.', 'déc.']
+
+#Format a meteofrance date (milliseconds since epoch, UTC) as "%a - %d %b" in French without changing the process locale,
+#which is neither cheap nor thread-safe
+def formatFrenchDate(iTimestamp):
+    aTime = time.gmtime(iTimestamp / 1000)
+    return '{} - {:02d} {}'.format(FRENCH_DAYS[aTime.tm_wday], aTime.tm_mday, FRENCH_MONTHS[aTime.tm_mon - 1])
+
+#Build the right output screen with details at day level, period level, and range of our level, refining data when available.
+#iStoredAt is the time the forecast was fetched at when it comes from a cache or a snapshot, now otherwise
+@stageSeconds.timed('buildCleanObject')
+def buildCleanObject(iConfig, iData, iStoredAt=None):
     aData = {
         'nom':           iData['result']['ville']['nom'],
         'numDept':       iData['result']['ville']['numDept'],
         'nomDept':       iData['result']['ville']['nomDept'],
         'region':        iData['result']['ville']['region'],
         'pays':          iData['result']['ville']['pays'],
-        'meteoDateTime': datetime.datetime.now().strftime("%H:%M %d%b"),
+        'meteoDateTime': (datetime.datetime.now() if iStoredAt is None else datetime.datetime.fromtimestamp(iStoredAt)).strftime("%H:%M %d%b"),
         'titles':        ["Date", "Temps", "Température", "Vent", "Pluie (%)"],
         'previsions': []
         }
 
-    #Go throught the 10 days of daily prevision in resumes section
-    myRange = range(0, 100)
-    
-
-    #Do the actual display
-    for i in myRange:
-        keyResumes = str(i)+'_resume'
-        if keyResumes in iData['result' ]['resumes']:
-            # get current locale
-            loc = locale.getlocale()
-            # Force locale to French
-            try:
-                #print(locale.locale_alias)
-                #locale.setlocale(locale.LC_ALL, 'fr_fr.ISO8859-1')
-                #locale.setlocale(locale.LC_ALL, 'eu_FR.ISO8859-1')
-                locale.setlocale(locale.LC_ALL, 'fr_FR.UTF-8')
-            except:
-                try:
-                    locale.setlocale(locale.LC_ALL, 'fr_FR.ISO8859-1')
-                except:
-                    print("Erreur de LOCALE")
-                    pass
-                pass
-            timeString = time.strftime("%a - %d %b", time.gmtime(iData['result']['resumes'][keyResumes]['date'] / 1000))
-            # restore saved locale
-            try:
-                locale.setlocale(locale.LC_ALL, loc)
-            except:
-                pass
+    #Go throught the days of daily prevision in resumes section, then their periods
+    for aDay in normalizeForecast(iData).days:
+        if aDay.hasResume:
             aData['previsions'].append( {
-                'date':          timeString,
-                'description':    iData['result']['resumes'][keyResumes]['description'],
-                'temperatureMin': iData['result']['resumes'][keyResumes]['temperatureMin'],
-                'temperatureMax': iData['result']['resumes'][keyResumes]['temperatureMax'],
+                'date':           formatFrenchDate(aDay.date),
+                'description':    aDay.description,
+                'temperatureMin': aDay.temperatureMin,
+                'temperatureMax': aDay.temperatureMax,
                 'timeranges': []
             } )
-
-        #Then, display the prevision "by range matin, midi, soir, nuit" in previsions section
-        for r in ['matin', 'midi', 'soir', 'nuit']:
-            keyPrevisions = str(i)+'_'+r
-            if keyPrevisions in iData['result']['previsions']:
-                detailDisplayed = False
-                l = []
-                if r == 'matin':
-                    l = [str(i) + '_' + x for x in ['07-10', '10-13']]
-                if r == 'midi':
-                    l = [str(i) + '_' + x for x in ['13-16', '16-19']]
-                if r == 'soir':
-                    l = [str(i) + '_' + x for x in ['19-22']]
-                if r == 'nuit':
-                    l = [str(i) + '_' + x for x in ['22-01']] + [str(i+1) + '_' + x for x in ['01-04', '04-07']]                
-                
-                for keyPrevisions48h in l:
-                    if keyPrevisions48h in iData['result']['previsions48h']:
-                        aData['previsions'][-1]['timeranges'].append( {
-                            '_timerange':               keyPrevisions48h[2:]+'h',
-                            'description':    iData['result']['previsions48h'][keyPrevisions48h]['description'],
-                            'temperatureMin': iData['result']['previsions48h'][keyPrevisions48h]['temperatureMin'],
-                            'temperatureMax': iData['result']['previsions48h'][keyPrevisions48h]['temperatureMax'],
-                            'vitesseVent':    iData['result']['previsions48h'][keyPrevisions48h]['vitesseVent'],
-                            'probaPluie':     iData['result']['previsions48h'][keyPrevisions48h]['probaPluie']
-                        } )
-                        #Uncomment the below to remove duplicate data and only keep the more precised one
-                        detailDisplayed = True
-
-                if not detailDisplayed:
-                    aData['previsions'][-1]['timeranges'].append( {
-                        '_timerange':            r,
-                        'description':      iData['result']['previsions'][keyPrevisions]['description'],
-                        'temperature':      iData['result']['previsions'][keyPrevisions]['temperatureCarte'],
-                        'vitesseVent':      iData['result']['previsions'][keyPrevisions]['vitesseVent']
-                        } )
+        if not aData['previsions']:
+            continue
+
+        #Then, the prevision "by range matin, midi, soir, nuit", keeping only the more precised data when available
+        for aPeriod in aDay.periods:
+            for r in aPeriod.timeranges:
+                aData['previsions'][-1]['timeranges'].append( {
+                    '_timerange':     r.timerange+'h',
+                    'description':    r.description,
+                    'temperatureMin': r.temperatureMin,
+                    'temperatureMax': r.temperatureMax,
+                    'vitesseVent':    r.vitesseVent,
+                    'probaPluie':     r.probaPluie
+                } )
+
+            if not aPeriod.timeranges:
+                aData['previsions'][-1]['timeranges'].append( {
+                    '_timerange':     aPeriod.name,
+                    'description':    aPeriod.description,
+                    'temperature':    aPeriod.temperature,
+                    'vitesseVent':    aPeriod.vitesseVent
+                    } )
     #pp = pprint.PrettyPrinter(indent=2)
     #pp.pprint(iConfig)
     #pp.pprint(aData)
     return aData
 
 #Build the HTML output screen with details at day level, period level, and range of our level, refining data when available
+@stageSeconds.timed('formatOutputForWeb')
 def formatOutputForWeb(iConfig, iCleanData, iFrequentRequests=None):
-    env = Environment(
-        loader=PackageLoader('gmet', 'templates'),
-        autoescape=select_autoescape(['html', 'xml'])
-        )
-    template = env.get_template('output_template.html.jinja')
-    return template.render(iCleanData, frequents=iFrequentRequests)
-    
+    return getOutputTemplate().render(iCleanData, frequents=iFrequentRequests)
+
+#Build the Jinja environment on first use. Compiled templates can also be kept on disk (template_cache_dir) for fast worker startup
+#Concurrent first calls may build it twice, which is harmless
+def getOutputTemplate():
+    global templateEnvironment, outputTemplate
+    if templateEnvironment is None:
+        from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache, select_autoescape
+        aBytecodeCache = None
+        aBytecodeDir = getConfigValue('template_cache_dir')
+        if aBytecodeDir:
+            os.makedirs(aBytecodeDir, exist_ok=True)
+            aBytecodeCache = FileSystemBytecodeCache(aBytecodeDir)
+        templateEnvironment = Environment(
+            loader=PackageLoader('gmet', 'templates'),
+            autoescape=select_autoescape(['html', 'xml']),
+            auto_reload=TEMPLATE_AUTO_RELOAD,
+            bytecode_cache=aBytecodeCache
+            )
+    if outputTemplate is None or TEMPLATE_AUTO_RELOAD:
+        outputTemplate = templateEnvironment.get_template(TEMPLATE_NAME)
+    return outputTemplate
+
+#Split a batch entry "name", "inseecode" or "name,inseecode" into (name, inseecode). Name is None for a bare Insee Code
+def parseBatchEntry(iEntry):
+    aName, aSeparator, aInseeCode = iEntry.partition(',')
+    aName = aName.strip()
+    aInseeCode = aInseeCode.strip() or None
+    if aInseeCode is None and INSEE_CODE.fullmatch(aName):
+        return None, aName
+    return aName, aInseeCode
+
+def readBatchFile(iFilename):
+    with open(iFilename, encoding='utf-8') as f:
+        return [l.strip() for l in f if l.strip() and not l.lstrip().startswith('#')]
+
+#iDeadline (time.monotonic) bounds the upstream calls, it is entered here as deadlines are per thread
+def getForecastForEntry(iEntry, iDeadline=None):
+    if iDeadline is not None:
+        with upstreamClient.deadline(iDeadline - time.monotonic()):
+            return getForecastForEntry(iEntry)
+    aName, aInseeCode = parseBatchEntry(iEntry)
+    if aName is not None:
+        aInseeCode = getInseeCode(aName, aInseeCode)[0]
+    return getForecastEntry(aInseeCode)
+
+#Fetch the forecasts of several cities with a pool of iJobs threads. Yield (entry, forecast cache entry, error) for each of them,
+#as soon as it is available, or in the order of iEntries when iOrdered is set.
+#When the caller stops early (e.g. the client of /batch disconnects), the pending fetches are cancelled, not waited for
+def fetchBatch(iEntries, iJobs=BATCH_JOBS, iOrdered=False, iDeadline=None):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    if not iEntries:
+        return
+    aPool = ThreadPoolExecutor(max_workers=max(1, min(iJobs, len(iEntries))))
+    aFutures = {}
+    try:
+        aFutures = {aPool.submit(getForecastForEntry, e, iDeadline): e for e in iEntries}
+        for aFuture in (list(aFutures) if iOrdered else as_completed(aFutures)):
+            try:
+                yield aFutures[aFuture], aFuture.result(), None
+            except (ValueError, IOError) as error:
+                yield aFutures[aFuture], None, error
+    finally:
+        for aFuture in aFutures:
+            aFuture.cancel()
+        aPool.shutdown(wait=False)
+
+def executeBatch(iArgs):
+    aEntries = list(iArgs.cities or [])
+    if iArgs.file:
+        aEntries += readBatchFile(iArgs.file)
+    aFailed = []
+    for aEntry, aForecast, error in fetchBatch(aEntries, iArgs.jobs, iOrdered=True):
+        if error is not None:
+            logging.error("{}: {}".format(aEntry, error))
+            aFailed.append(aEntry)
+        elif iArgs.json_output:
+            print(json.dumps(buildCleanObject(iArgs, aForecast.value), ensure_ascii=False))
+        elif iArgs.terminal_output:
+            formatOutputForTerminal(iArgs, aForecast.value)
+    if aFailed:
+        raise ValueError('No forecast for: ' + ', '.join(aFailed))
+
+#Snapshot store of the command line, opened on first use. The city index is loaded from it so that known cities resolve offline
+def openSnapshotStore():
+    global snapshotStore
+    if snapshotStore is None:
+        snapshotStore = SnapshotStore()
+        cityIndex.load(snapshotStore.getCityIndexPath())
+    return snapshotStore
+
+#Start a detached process refreshing the snapshots of this city, so that this one can print and exit right away
+def startSnapshotRefresh(iArgs):
+    import subprocess
+    aCommand = [sys.executable, '-m', 'gmet', '--refresh-snapshot', '--log', 'ERROR']
+    if iArgs.city is not None:
+        aCommand += ['--city', iArgs.city]
+    if iArgs.inseecode is not None:
+        aCommand += ['--inseecode', iArgs.inseecode]
+    aEnv = dict(os.environ)
+    aEnv['PYTHONPATH'] = os.pathsep.join([p for p in [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), aEnv.get('PYTHONPATH')] if p])
+    try:
+        subprocess.Popen(aCommand, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=aEnv, start_new_session=True)
+    except OSError as error:
+        logging.debug("Snapshot refresh not started: {}".format(error))
+
+#Fast start: print the forecast from the snapshots without any network call, then refresh them in background when old enough.
+#Return False when the city or its forecast is not in the snapshots
+def executeFromSnapshot(iArgs, iSnapshots):
+    aCity = iArgs.city
+    if aCity is None:
+        aLocation = iSnapshots.loadLocation()
+        if aLocation is None:
+            return False
+        aCity = aLocation[1]['city']
+    if cityIndex.lookup(aCity) is None:
+        return False
+    aSnapshot = iSnapshots.loadForecast(getInseeCode(aCity, iArgs.inseecode)[0])
+    if aSnapshot is None:
+        return False
+
+    aRefreshing = iSnapshots.age(aSnapshot[0]) > SNAPSHOT_REFRESH_AGE
+    outputForecast(iArgs, aSnapshot[1], aSnapshot[0], aRefreshing)
+    if aRefreshing:
+        startSnapshotRefresh(iArgs)
+    return True
+
+#Write the forecast in the formats asked on the command line. iStoredAt is the time of the snapshot when not fetched live
+def outputForecast(iArgs, iData, iStoredAt=None, iRefreshing=False):
+    if iStoredAt is not None:
+        aStale = '-- Stale forecast from {}{} --'.format(time.strftime("%d/%m %H:%M", time.localtime(iStoredAt)), ', refreshing in background' if iRefreshing else '')
+        if iArgs.terminal_output and not iArgs.json_output:
+            print(CORANGE + aStale + CEND)
+        else:
+            logging.warning(aStale)
+    if iArgs.json_output:
+        print(json.dumps(buildCleanObject(iArgs, iData, iStoredAt), ensure_ascii=False))
+    elif iArgs.terminal_output:
+        formatOutputForTerminal(iArgs, iData)
+    if iArgs.html_output:
+        cleanData = buildCleanObject(iArgs, iData, iStoredAt)
+        aOutput_html = formatOutputForWeb(iArgs, cleanData)
+        filename = "output.html"
+        try:
+            os.remove(filename)
+        except:
+            pass
+        f = open(filename, 'w')
+        f.write(aOutput_html)
+        f.close()
+        os.system("chromium "+filename)
 
 def executeScript(iArgs):
+    if iArgs.cities or iArgs.file:
+        return executeBatch(iArgs)
+
+    aSnapshots = openSnapshotStore()
+    if iArgs.fast and not iArgs.watch and executeFromSnapshot(iArgs, aSnapshots):
+        return
+
     data = {}
     if iArgs.city is None:
         logging.debug("No city, trying to localize")
-        data = localize()
+        try:
+            data = localize()
+            aSnapshots.saveLocation(data)
+        except IOError as error:
+            aLocation = aSnapshots.loadLocation()
+            if aLocation is None:
+                raise
+            logging.warning("Localization failed, using the last known location: {}".format(error))
+            data = aLocation[1]
         logging.debug(data)
     else:
         data['ip'] = None
@@ -283,29 +630,37 @@ def executeScript(iArgs):
 
 
     data['insee'], data['city'], data['zip'], data['depName'], data['depNum'], data['country'] = getInseeCode(data['city'], iArgs.inseecode)
-    data = getDataFromMeteoFranceAPI(data['insee'])
-    if iArgs.terminal_output:
-        formatOutputForTerminal(iArgs, data)
-    if iArgs.html_output:
-        cleanData = buildCleanObject(iArgs, data)
-        aOutput_html = formatOutputForWeb(iArgs, cleanData)
-        filename = "output.html"
-        try:
-            os.remove(filename)
-        except:
-            pass
-        f = open(filename, 'w')
-        f.write(aOutput_html)
-        f.close()
-        os.system("chromium "+filename)
+    cityIndex.save(aSnapshots.getCityIndexPath())
+
+    #Live data is saved for the next runs, the snapshot is used when upstream is not reachable
+    aStoredAt = None
+    try:
+        aForecast = getDataFromMeteoFranceAPI(data['insee'])
+        aSnapshots.saveForecast(data['insee'], aForecast)
+    except IOError as error:
+        aSnapshot = aSnapshots.loadForecast(data['insee'])
+        if aSnapshot is None:
+            raise
+        logging.warning("Meteo France not reachable, using the last known forecast: {}".format(error))
+        aStoredAt, aForecast = aSnapshot
+
+    if iArgs.watch and iArgs.terminal_output and not iArgs.json_output:
+        executeWatch(iArgs, data['insee'], aForecast)
+    elif not iArgs.refresh_snapshot:
+        outputForecast(iArgs, aForecast, aStoredAt)
 
 def executeWeb(iArgs, iIP=None):
     data = {}
     if iArgs.city is None:
         logging.debug("No city, trying to localize")
-        data = localize(iIP)
+        try:
+            data = localize(iIP)
+        except IOError as error:
+            logging.warning("Localization of {} failed: {}".format(iIP, error))
+            data = {'ip': iIP, 'bogon': True}
         data['insee'] = None
-        if 'bogon' in data:
+        #ipinfo does not always know the city of an address
+        if 'bogon' in data or not data.get('city'):
             data['city'] = "Paris"
             data['insee'] = "751010"
     else:
@@ -315,47 +670,197 @@ def executeWeb(iArgs, iIP=None):
 
     try:
         data['insee'], data['city'], data['zip'], data['depName'], data['depNum'], data['country'] = getInseeCode(data['city'], data['insee'])
-    except:
+    except (ValueError, IOError) as error:
+        #Show Paris instead. When getLieux is down, Paris must already be in the city index: asking getLieux again
+        #would only add load to a failing upstream
+        logging.warning("City {} not resolved, showing Paris: {}".format(data['city'], error))
         data['ip'] = None
-        data['city'] = "Paris"
-        data['insee'] = "751010"
-        data['insee'], data['city'], data['zip'], data['depName'], data['depNum'], data['country'] = getInseeCode(data['city'], data['insee'])
-    data = getDataFromMeteoFranceAPI(data['insee'])
-    cleanData = buildCleanObject(iArgs, data)
-    cacheCityRequested(cleanData['nom'])
-    return formatOutputForWeb(iArgs, cleanData, getFrequentRequests())
+        aParis = cityIndex.lookupInsee("751010")
+        if aParis is None:
+            if isHostDown(error):
+                raise
+            aParis = getInseeCode("Paris", "751010")
+        data['insee'], data['city'], data['zip'], data['depName'], data['depNum'], data['country'] = aParis
+    aForecast = getForecastEntry(data['insee'])
+    cacheCityRequested(aForecast.value['result']['ville']['nom'])
+    aFrequents = getFrequentRequests()
+
+    aPageKey = (data['insee'], aForecast.version, aForecast.storedAt, tuple(aFrequents))
+    aPage = pageCache.lookup(aPageKey)
+    if aPage is None:
+        cleanData = buildCleanObject(iArgs, aForecast.value, aForecast.storedAt)
+        aPage = formatOutputForWeb(iArgs, cleanData, aFrequents)
+        pageCache.set(aPageKey, aPage)
+    return aPage
 
 def cacheCityRequested(iCity):
-    if iCity in cacheRequests:
-        cacheRequests[iCity] += 1
-    else:
-        cacheRequests[iCity] = 1
+    try:
+        requestTracker.offer(iCity)
+    except IOError as error:
+        logging.warning("Request of {} not counted: {}".format(iCity, error))
+
+#INSEE codes of the favorites and the most requested cities, the ones the prefetch scheduler keeps warm
+def getPrefetchTargets(iTop=PREFETCH_TOP):
+    aTargets = []
+    for aCity in getFrequentRequests()[:iTop]:
+        try:
+            aTargets.append(getInseeCode(aCity)[0])
+        except (ValueError, IOError) as error:
+            logging.debug("Prefetch: {} not resolved: {}".format(aCity, error))
+    return aTargets
+
+#A forecast is refreshed when missing, or when it expires before the next two prefetch runs
+def forecastNeedsRefresh(iCityInseeCode):
+    aExpiresIn = forecastCache.expiresIn(iCityInseeCode)
+    return aExpiresIn is None or aExpiresIn < 2 * prefetchScheduler.interval
+
+def refreshForecast(iCityInseeCode):
+    forecastCache.set(iCityInseeCode, getDataFromMeteoFranceAPI(iCityInseeCode))
+
+def startPrefetch(iTop=PREFETCH_TOP, iInterval=PREFETCH_INTERVAL, iRatePerMinute=PREFETCH_RATE):
+    global prefetchScheduler
+    if prefetchScheduler is None:
+        prefetchScheduler = PrefetchScheduler(lambda: getPrefetchTargets(iTop), forecastNeedsRefresh, refreshForecast,
+                                              iInterval=iInterval, iBudget=RateBudget(iRatePerMinute))
+    prefetchScheduler.start()
+    return prefetchScheduler
+
+#Content of the configuration file as a dict, parsed again only when the file changes (e.g. ConfigMap update)
+def loadConfig():
+    global configMtime, configValues
+    try:
+        aMtime = os.stat(CONFIG_FILE).st_mtime_ns
+    except OSError:
+        return {}
+    if aMtime != configMtime:
+        from jproperties import Properties
+        configs = Properties()
+        try:
+            with open(CONFIG_FILE, 'rb') as config_file:
+                configs.load(config_file)
+            configValues = {k: v.data for k, v in configs.items()}
+        except Exception as error:
+            logging.warning("Configuration file {} not loaded: {}".format(CONFIG_FILE, error))
+            configValues = {}
+        configMtime = aMtime
+    return configValues
+
+def getConfigValue(iKey, iDefault=None):
+    aValue = loadConfig().get(iKey)
+    return iDefault if aValue is None else aValue.strip()
+
+#Apply the settings of the configuration file, done once by the web server
+def configureServer():
+    global serverConfigured
+    configureUpstream()
+    configureBackend()
+    configureCaches()
+    configureMetrics()
+    if getConfigValue('prefetch_enabled', 'true').lower() == 'true':
+        startPrefetch(iTop=int(getConfigValue('prefetch_top', PREFETCH_TOP)),
+                      iInterval=float(getConfigValue('prefetch_interval', PREFETCH_INTERVAL)),
+                      iRatePerMinute=float(getConfigValue('prefetch_rate', PREFETCH_RATE)))
+    serverConfigured = True
+
+def configureUpstream():
+    global requestDeadline
+    upstreamClient.configure(iMaxConnectionsPerHost=int(getConfigValue('upstream_max_connections', UPSTREAM_MAX_CONNECTIONS)),
+                             iConnectTimeout=float(getConfigValue('upstream_connect_timeout', UPSTREAM_CONNECT_TIMEOUT)),
+                             iReadTimeout=float(getConfigValue('upstream_read_timeout', UPSTREAM_READ_TIMEOUT)),
+                             iMaxRetries=int(getConfigValue('upstream_max_retries', UPSTREAM_MAX_RETRIES)),
+                             iBackoff=float(getConfigValue('upstream_backoff', UPSTREAM_BACKOFF)),
+                             iBreakerFailures=int(getConfigValue('upstream_breaker_failures', UPSTREAM_BREAKER_FAILURES)),
+                             iBreakerReset=float(getConfigValue('upstream_breaker_reset', UPSTREAM_BREAKER_RESET)))
+    requestDeadline = float(getConfigValue('request_deadline', REQUEST_DEADLINE))
+
+#Metrics are on unless metrics_enabled is false. With metrics_profile_rate above 0, that fraction of the requests is profiled
+def configureMetrics():
+    metricsRegistry.enabled = getConfigValue('metrics_enabled', 'true').lower() == 'true'
+    requestProfiler.rate = float(getConfigValue('metrics_profile_rate', 0))
+    requestProfiler.keep = int(getConfigValue('metrics_profile_keep', METRICS_PROFILE_KEEP))
+
+#Select the cache backend from its url (cache_backend: memory, sqlite:///dev/shm/gmet-cache.db or redis://host:6379/0)
+#Forecasts and city resolutions only go through it when it is shared with other processes, they are in-process anyway
+def configureBackend():
+    global cacheBackend
+    from gmet.backends import createBackend
+    aUrl = getConfigValue('cache_backend', 'memory')
+    try:
+        aBackend = createBackend(aUrl)
+    except (ValueError, IOError) as error:
+        logging.error("Cache backend {} not available, using memory: {}".format(aUrl, error))
+        return
+    logging.info("Cache backend: {}".format(aUrl))
+    cacheBackend = aBackend
+    requestTracker.backend = aBackend
+    forecastCache.backend = aBackend if aBackend.shared else None
+    cityIndex.backend = aBackend if aBackend.shared else None
+
+def configureCaches():
+    forecastCache.configure(iTTL=int(getConfigValue('forecast_ttl', FORECAST_CACHE_TTL)),
+                            iStaleTTL=int(getConfigValue('forecast_stale_ttl', FORECAST_CACHE_STALE_TTL)),
+                            iMaxSize=int(getConfigValue('forecast_cache_size', FORECAST_CACHE_SIZE)))
+    geolocationCache.configure(iTTL=int(getConfigValue('geolocation_ttl', GEOLOCATION_CACHE_TTL)),
+                               iMaxSize=int(getConfigValue('geolocation_cache_size', GEOLOCATION_CACHE_SIZE)))
+    requestTracker.capacity = int(getConfigValue('frequent_capacity', FREQUENT_CAPACITY))
+    requestTracker.halfLife = float(getConfigValue('frequent_half_life', FREQUENT_HALF_LIFE))
+    cityIndex.maxSize = int(getConfigValue('city_index_size', CITY_INDEX_SIZE))
+    cityIndex.unknownTTL = int(getConfigValue('city_index_unknown_ttl', CITY_INDEX_UNKNOWN_TTL))
+    aCityIndexFile = getConfigValue('city_index_file')
+    if aCityIndexFile:
+        logging.info("{} cities loaded from {}".format(cityIndex.load(aCityIndexFile), aCityIndexFile))
+        atexit.register(cityIndex.save, aCityIndexFile)
+
+def getCacheStats():
+    aStats = {
+        'forecast':    forecastCache.stats(),
+        'geolocation': geolocationCache.stats(),
+        'page':        pageCache.stats(),
+        'cities':      cityIndex.stats(),
+        'upstream':    upstreamClient.stats(),
+        'frequent':    requestTracker.stats()
+        }
+    if prefetchScheduler is not None:
+        aStats['prefetch'] = prefetchScheduler.stats()
+    return aStats
+
+#Per cache, (hits, misses, hit ratio) as {(cache,): value} for the collected metrics, iField being the index in that triple
+#and iStats a result of getCacheStats
+def getCacheCounters(iStats, iField):
+    aCounters = {}
+    for aName in ('forecast', 'geolocation', 'page', 'cities'):
+        aHits = iStats[aName]['hits'] + iStats[aName].get('staleHits', 0) + iStats[aName]['sharedHits']
+        aMisses = iStats[aName]['misses']
+        aCounters[(aName,)] = (aHits, aMisses, aHits / (aHits + aMisses) if aHits + aMisses else 0.0)[iField]
+    return aCounters
+
+def getUpstreamCounters(iStats, iField):
+    return {(aHost,): aStats[iField] for aHost, aStats in iStats['upstream']['hosts'].items() if iField in aStats}
+
+#Metrics in the Prometheus text format for /metrics, None when they are disabled
+def runMetrics():
+    if not serverConfigured:
+        configureServer()
+    if not metricsRegistry.enabled:
+        return None
+    return metricsRegistry.render()
 
 def getFavorites():
-    configs = Properties()
-
-    try:
-        with open('config/config.ini', 'rb') as config_file:
-            configs.load(config_file)
-        my_list = configs.get("favorites").data.replace(" ", "").split(',')
-        return my_list
-    except :
+    aFavorites = loadConfig().get("favorites")
+    if aFavorites is None:
         return ['Biot', 'Eysines', 'Ustaritz']
-    
+    return aFavorites.replace(" ", "").split(',')
 
+#Favorites first, in their configuration order, then the most requested cities
 def getFrequentRequests():
-    cacheRequestsItems = sorted(cacheRequests.items() , reverse=True, key=lambda x: x[1])
-    cacheRequestsLists = [i[0] for i in cacheRequestsItems]
-    cacheRequestsLists = cacheRequestsLists[:47]
-
-    favorites = getFavorites()
-    favorites.reverse()
-    for aCity in favorites:
-        if aCity in cacheRequestsLists:
-            cacheRequestsLists.remove(aCity)
-        cacheRequestsLists.insert(0,aCity)
-
-    return cacheRequestsLists
+    try:
+        aTop = requestTracker.top(FREQUENT_TOP)
+    except IOError as error:
+        logging.warning("Request counters not available: {}".format(error))
+        aTop = []
+    aFavorites = list(dict.fromkeys(getFavorites()))
+    aFavoritesSet = set(aFavorites)
+    return aFavorites + [aCity for aCity in aTop if aCity not in aFavoritesSet]
 
 # Example of dummy function to test pytest - TO BE REMOVED ONCE pytest well integrated
 def func(x):
@@ -403,6 +908,53 @@ def runWeb(iIP=None, iCity=None):
     #                   filename=args.log_file,
                         level=args.loglevel)
 
+    if not serverConfigured:
+        configureServer()
+
     logging.info("From {0} with arguments {1}".format(str(iIP), str(iCity)))
 
-    return executeWeb(args, iIP)
\ No newline at end of file
+    with upstreamClient.deadline(requestDeadline):
+        return executeWeb(args, iIP)
+
+#Forecast of a city for the JSON API, iCity being a name or an Insee Code. Return the buildCleanObject structure,
+#the version of the forecast and the time it was fetched at, from which the API derives its ETag and Last-Modified headers
+def runApi(iCity, iInseeCode=None):
+    if not serverConfigured:
+        configureServer()
+
+    logging.info("API request for {0} {1}".format(iCity, str(iInseeCode)))
+
+    aName, aInseeCode = parseBatchEntry(iCity)
+    with upstreamClient.deadline(requestDeadline):
+        if aName is not None:
+            aInseeCode = getInseeCode(aName, iInseeCode or aInseeCode)[0]
+        aForecast = getForecastEntry(aInseeCode)
+
+    aKey = ('api', aInseeCode, aForecast.version, aForecast.storedAt)
+    cleanData = pageCache.lookup(aKey)
+    if cleanData is None:
+        cleanData = buildCleanObject(None, aForecast.value, aForecast.storedAt)
+        pageCache.set(aKey, cleanData)
+    return cleanData, aForecast.version, aForecast.modifiedAt
+
+#JSON lines of a forecast: the city first, then one line per day
+def formatOutputForNdjson(iCleanData):
+    yield json.dumps({k: v for k, v in iCleanData.items() if k != 'previsions'}, ensure_ascii=False) + '\n'
+    for aDay in iCleanData['previsions']:
+        yield json.dumps(aDay, ensure_ascii=False) + '\n'
+
+#Forecasts of several cities for the web server, as JSON lines streamed as soon as each city is available
+def runWebBatch(iEntries):
+    if not serverConfigured:
+        configureServer()
+
+    logging.info("Batch of {} cities".format(len(iEntries)))
+
+    for aEntry in iEntries[BATCH_MAX_CITIES:]:
+        yield json.dumps({'city': aEntry, 'error': 'Too many cities, at most {} per request'.format(BATCH_MAX_CITIES)}, ensure_ascii=False) + '\n'
+    aDeadline = time.monotonic() + requestDeadline
+    for aEntry, aForecast, error in fetchBatch(iEntries[:BATCH_MAX_CITIES], iDeadline=aDeadline):
+        if error is not None:
+            yield json.dumps({'city': aEntry, 'error': str(error)}, ensure_ascii=False) + '\n'
+        else:
+            yield json.dumps({'city': aEntry, 'forecast': buildCleanObject(None, aForecast.value, aForecast.storedAt)}, ensure_ascii=False) + '\n'
\ No newline at end of file
@@ -0,0 +1,86 @@
+#Interface of the cache backends (see backends.py) and the in-process one, the default until configureBackend selects another.
+#Kept apart from backends.py so that the command line, which only needs this one, does not load sqlite3
+
+import time
+import threading
+
+
+class CacheBackendError(IOError):
+    pass
+
+
+#Interface of the backends. shared is True when other processes see the same data
+class CacheBackend(object):
+    shared = False
+
+    def get(self, iKey):
+        raise NotImplementedError
+
+    #iTTL in seconds, None for no expiry
+    def set(self, iKey, iValue, iTTL=None):
+        raise NotImplementedError
+
+    def delete(self, iKey):
+        raise NotImplementedError
+
+    #Add iAmount to the counter iField of the hash iName, return its new value
+    def incr(self, iName, iField, iAmount=1):
+        raise NotImplementedError
+
+    #Return all the counters of the hash iName as a dict
+    def getCounters(self, iName):
+        raise NotImplementedError
+
+    def setCounter(self, iName, iField, iValue):
+        raise NotImplementedError
+
+    def deleteCounter(self, iName, iField):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(CacheBackend):
+
+    def __init__(self, iClock=time.time):
+        self._clock = iClock
+        self._lock = threading.Lock()
+        self._values = {}
+        self._counters = {}
+
+    def get(self, iKey):
+        with self._lock:
+            aItem = self._values.get(iKey)
+            if aItem is None:
+                return None
+            if aItem[1] is not None and aItem[1] <= self._clock():
+                del self._values[iKey]
+                return None
+            return aItem[0]
+
+    def set(self, iKey, iValue, iTTL=None):
+        with self._lock:
+            self._values[iKey] = (iValue, None if iTTL is None else self._clock() + iTTL)
+
+    def delete(self, iKey):
+        with self._lock:
+            self._values.pop(iKey, None)
+
+    def incr(self, iName, iField, iAmount=1):
+        with self._lock:
+            aCounters = self._counters.setdefault(iName, {})
+            aCounters[iField] = aCounters.get(iField, 0) + iAmount
+            return aCounters[iField]
+
+    def getCounters(self, iName):
+        with self._lock:
+            return dict(self._counters.get(iName, {}))
+
+    def setCounter(self, iName, iField, iValue):
+        with self._lock:
+            self._counters.setdefault(iName, {})[iField] = iValue
+
+    def deleteCounter(self, iName, iField):
+        with self._lock:
+            self._counters.get(iName, {}).pop(iField, None)
@@ -0,0 +1,227 @@
+#Metrics of the web server (counters, gauges, latency histograms), rendered in the Prometheus text format for /metrics.
+#While the registry is disabled, updating a metric is a single attribute test, so instrumented code paths stay cheap.
+
+import time
+import heapq
+import bisect
+import functools
+import threading
+
+#Latency buckets in seconds, from a local cache hit to a slow upstream call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def formatLabels(iNames, iValues, iExtra=''):
+    aPairs = ['{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for n, v in zip(iNames, iValues)]
+    if iExtra:
+        aPairs.append(iExtra)
+    return '{' + ','.join(aPairs) + '}' if aPairs else ''
+
+def formatValue(iValue):
+    if iValue == float('inf'):
+        return '+Inf'
+    return repr(float(iValue)) if isinstance(iValue, float) else str(iValue)
+
+
+#Base of the metrics: a name, a help text and label names. Values are kept per tuple of label values
+class Metric(object):
+    type = None
+
+    def __init__(self, iRegistry, iName, iHelp, iLabels=()):
+        self.registry = iRegistry
+        self.name = iName
+        self.help = iHelp
+        self.labels = tuple(iLabels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self, iSnapshot=None):
+        with self._lock:
+            return [(self.name, k, v) for k, v in sorted(self._values.items())]
+
+    def render(self, iSnapshot=None):
+        aLines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        for aName, aLabelValues, aValue in self.samples(iSnapshot):
+            aLines.append('{}{} {}'.format(aName, formatLabels(self.labels, aLabelValues), formatValue(aValue)))
+        return aLines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, iLabelValues=(), iAmount=1):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[iLabelValues] = self._values.get(iLabelValues, 0) + iAmount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, iValue, iLabelValues=()):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[iLabelValues] = iValue
+
+    def inc(self, iLabelValues=(), iAmount=1):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[iLabelValues] = self._values.get(iLabelValues, 0) + iAmount
+
+    def dec(self, iLabelValues=(), iAmount=1):
+        self.inc(iLabelValues, -iAmount)
+
+
+#Cumulative histogram: per tuple of label values, the count of observations in each bucket, their sum and their count
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, iRegistry, iName, iHelp, iLabels=(), iBuckets=DEFAULT_BUCKETS):
+        super().__init__(iRegistry, iName, iHelp, iLabels)
+        self.buckets = tuple(sorted(iBuckets))
+
+    def observe(self, iValue, iLabelValues=()):
+        if not self.registry.enabled:
+            return
+        aIndex = bisect.bisect_left(self.buckets, iValue)
+        with self._lock:
+            aValue = self._values.get(iLabelValues)
+            if aValue is None:
+                aValue = self._values[iLabelValues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            aValue[0][aIndex] += 1
+            aValue[1] += iValue
+            aValue[2] += 1
+
+    #Decorator observing the duration of each call of the function, labelled with iLabelValues
+    def timed(self, *iLabelValues):
+        def decorator(iFunc):
+            @functools.wraps(iFunc)
+            def wrapper(*iArgs, **iKwargs):
+                if not self.registry.enabled:
+                    return iFunc(*iArgs, **iKwargs)
+                aStart = time.perf_counter()
+                try:
+                    return iFunc(*iArgs, **iKwargs)
+                finally:
+                    self.observe(time.perf_counter() - aStart, iLabelValues)
+            return wrapper
+        return decorator
+
+    def render(self, iSnapshot=None):
+        aLines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        with self._lock:
+            aValues = sorted((k, ([c for c in v[0]], v[1], v[2])) for k, v in self._values.items())
+        for aLabelValues, (aCounts, aSum, aCount) in aValues:
+            aCumulated = 0
+            for aBound, aBucketCount in zip(self.buckets + (float('inf'),), aCounts):
+                aCumulated += aBucketCount
+                aLines.append('{}_bucket{} {}'.format(self.name, formatLabels(self.labels, aLabelValues, 'le="{}"'.format(formatValue(aBound))), aCumulated))
+            aLines.append('{}_sum{} {}'.format(self.name, formatLabels(self.labels, aLabelValues), repr(aSum)))
+            aLines.append('{}_count{} {}'.format(self.name, formatLabels(self.labels, aLabelValues), aCount))
+        return aLines
+
+
+#Metric whose values are read when rendered, from iCollect(snapshot) returning {tuple of label values: value}. Used for the
+#statistics the caches and the upstream client already count, so that the request path does not count them twice
+class CollectedMetric(Metric):
+
+    def __init__(self, iRegistry, iName, iHelp, iLabels, iType, iCollect):
+        super().__init__(iRegistry, iName, iHelp, iLabels)
+        self.type = iType
+        self._collect = iCollect
+
+    def samples(self, iSnapshot=None):
+        return [(self.name, k, v) for k, v in sorted(self._collect(iSnapshot).items())]
+
+
+#iSnapshot, when given, is called once per render and its result passed to the collected metrics, so that a scrape reads
+#the statistics they share a single time
+class MetricsRegistry(object):
+
+    def __init__(self, iEnabled=False, iSnapshot=None):
+        self.enabled = iEnabled
+        self.snapshot = iSnapshot
+        self._metrics = []
+
+    def _add(self, iMetric):
+        self._metrics.append(iMetric)
+        return iMetric
+
+    def counter(self, iName, iHelp, iLabels=()):
+        return self._add(Counter(self, iName, iHelp, iLabels))
+
+    def gauge(self, iName, iHelp, iLabels=()):
+        return self._add(Gauge(self, iName, iHelp, iLabels))
+
+    def histogram(self, iName, iHelp, iLabels=(), iBuckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, iName, iHelp, iLabels, iBuckets))
+
+    def collected(self, iName, iHelp, iLabels, iType, iCollect):
+        return self._add(CollectedMetric(self, iName, iHelp, iLabels, iType, iCollect))
+
+    #All the metrics in the Prometheus text exposition format
+    def render(self):
+        aSnapshot = self.snapshot() if self.snapshot is not None else None
+        aLines = []
+        for aMetric in self._metrics:
+            aLines += aMetric.render(aSnapshot)
+        return '\n'.join(aLines) + '\n'
+
+
+#Sampling profiler: a fraction iRate of the requests runs under cProfile, and the iKeep slowest of them are kept
+#with their profile, so that the next optimization targets what is actually slow in production
+class RequestProfiler(object):
+
+    def __init__(self, iRate=0.0, iKeep=10, iRandom=None):
+        self.rate = iRate
+        self.keep = iKeep
+        self._random = iRandom
+        self._lock = threading.Lock()
+        self._slowest = []
+        self._sequence = 0
+        self.sampled = 0
+
+    #Return a running profile when this request is sampled, None otherwise
+    def start(self):
+        if self.rate <= 0:
+            return None
+        if self._random is None:
+            import random
+            self._random = random.random
+        if self._random() >= self.rate:
+            return None
+        import cProfile
+        aProfile = cProfile.Profile()
+        try:
+            aProfile.enable()
+        except ValueError:
+            #Another profiler is already running (a single one at a time since Python 3.12)
+            return None
+        return aProfile
+
+    def stop(self, iProfile, iName, iDuration):
+        iProfile.disable()
+        with self._lock:
+            self.sampled += 1
+            self._sequence += 1
+            aItem = (iDuration, self._sequence, iName, iProfile)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, aItem)
+            elif iDuration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, aItem)
+
+    #Report of the kept requests, slowest first, each with the iLines functions taking the most cumulative time
+    def report(self, iLines=25):
+        import io
+        import pstats
+        with self._lock:
+            aSlowest = sorted(self._slowest, reverse=True)
+        aReport = io.StringIO()
+        aReport.write('{} requests profiled, {} slowest kept\n'.format(self.sampled, len(aSlowest)))
+        for aDuration, aSequence, aName, aProfile in aSlowest:
+            aReport.write('\n=== {} in {:.1f} ms ===\n'.format(aName, aDuration * 1000))
+            pstats.Stats(aProfile, stream=aReport).sort_stats('cumulative').print_stats(iLines)
+        return aReport.getvalue()
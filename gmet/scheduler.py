@@ -0,0 +1,107 @@
+#Background prefetch of forecasts, so that the favorites and the most requested cities are refreshed before they expire
+
+import time
+import random
+import logging
+import threading
+
+
+#Token bucket limiting the number of upstream calls the scheduler may do: iRatePerMinute tokens per minute, at most iBurst in a row
+class RateBudget(object):
+
+    def __init__(self, iRatePerMinute=30, iBurst=5, iClock=time.monotonic):
+        self.rate = iRatePerMinute / 60.0
+        self.burst = iBurst
+        self._clock = iClock
+        self._tokens = float(iBurst)
+        self._updatedAt = iClock()
+        self._lock = threading.Lock()
+
+    def tryAcquire(self):
+        with self._lock:
+            aNow = self._clock()
+            self._tokens = min(self.burst, self._tokens + (aNow - self._updatedAt) * self.rate)
+            self._updatedAt = aNow
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+#Every iInterval seconds, ask iGetTargets() for the keys to keep warm, and call iRefresh(key) on those for which
+#iNeedsRefresh(key) is true. Refreshes are spread over the interval with some jitter, and skipped when the rate budget is spent.
+class PrefetchScheduler(object):
+
+    def __init__(self, iGetTargets, iNeedsRefresh, iRefresh, iInterval=60, iJitter=0.2, iBudget=None):
+        self.getTargets = iGetTargets
+        self.needsRefresh = iNeedsRefresh
+        self.refresh = iRefresh
+        self.interval = iInterval
+        self.jitter = iJitter
+        self.budget = iBudget if iBudget is not None else RateBudget()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def _jittered(self, iDelay):
+        return iDelay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    #One pass over the targets, returns the keys refreshed
+    def runOnce(self):
+        self.runs += 1
+        try:
+            aDue = [k for k in self.getTargets() if self.needsRefresh(k)]
+        except Exception as error:
+            logging.warning("Prefetch: cannot list targets: {}".format(error))
+            self.errors += 1
+            return []
+
+        aRefreshed = []
+        aSpacing = self.interval / (len(aDue) + 1)
+        for aKey in aDue:
+            if self._stop.is_set():
+                break
+            if not self.budget.tryAcquire():
+                self.skipped += 1
+                continue
+            try:
+                self.refresh(aKey)
+                self.refreshes += 1
+                aRefreshed.append(aKey)
+            except Exception as error:
+                logging.warning("Prefetch: refresh of {} failed: {}".format(aKey, error))
+                self.errors += 1
+            self._stop.wait(self._jittered(aSpacing))
+        return aRefreshed
+
+    def _run(self):
+        #Workers started together should not all prefetch at the same time
+        self._stop.wait(random.uniform(0, self.interval * self.jitter))
+        while not self._stop.is_set():
+            aStartedAt = time.monotonic()
+            self.runOnce()
+            self._stop.wait(max(0, self._jittered(self.interval) - (time.monotonic() - aStartedAt)))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+            self._thread.start()
+
+    def stop(self, iTimeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(iTimeout)
+
+    def stats(self):
+        return {
+            'running':   self._thread is not None and self._thread.is_alive(),
+            'interval':  self.interval,
+            'runs':      self.runs,
+            'refreshes': self.refreshes,
+            'errors':    self.errors,
+            'skipped':   self.skipped
+            }
@@ -0,0 +1,76 @@
+#On-disk snapshots of the last upstream answers, so that the command line can print a forecast without any network call
+
+import os
+import sys
+import time
+import marshal
+import logging
+
+#Files start with this header: marshal is the fastest format to load but it depends on the Python version
+SNAPSHOT_MAGIC = b'GMET1' + bytes(sys.version_info[:2])
+
+
+def getDefaultSnapshotDirectory():
+    if os.environ.get('GMET_CACHE_DIR'):
+        return os.environ['GMET_CACHE_DIR']
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'gmet')
+
+
+#Directory of snapshots: one file per getDetail answer (forecast-<insee>), the last localization of the computer (location),
+#and the city index (cities.json, see cityindex.py). Each file holds (time stored, data)
+class SnapshotStore(object):
+
+    def __init__(self, iDirectory=None, iClock=time.time):
+        self.directory = iDirectory or getDefaultSnapshotDirectory()
+        self._clock = iClock
+
+    def _path(self, iName):
+        return os.path.join(self.directory, iName)
+
+    #Return (time stored, data) or None when there is no usable snapshot
+    def load(self, iName):
+        try:
+            with open(self._path(iName), 'rb') as f:
+                aContent = f.read()
+        except IOError:
+            return None
+        if not aContent.startswith(SNAPSHOT_MAGIC):
+            return None
+        try:
+            return marshal.loads(aContent[len(SNAPSHOT_MAGIC):])
+        except (ValueError, EOFError, TypeError) as error:
+            logging.debug("Snapshot {} not readable: {}".format(iName, error))
+            return None
+
+    #Write through a temporary file so that a concurrent reader never sees a partial snapshot. Failures are not fatal
+    def save(self, iName, iData):
+        aPath = self._path(iName)
+        aTmpPath = '{}.{}.tmp'.format(aPath, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(aTmpPath, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC + marshal.dumps((self._clock(), iData)))
+            os.replace(aTmpPath, aPath)
+        except (IOError, ValueError) as error:
+            logging.debug("Snapshot {} not saved: {}".format(iName, error))
+            return False
+        return True
+
+    def loadForecast(self, iCityInseeCode):
+        return self.load('forecast-{}'.format(iCityInseeCode))
+
+    def saveForecast(self, iCityInseeCode, iData):
+        return self.save('forecast-{}'.format(iCityInseeCode), iData)
+
+    def loadLocation(self):
+        return self.load('location')
+
+    def saveLocation(self, iData):
+        return self.save('location', iData)
+
+    def getCityIndexPath(self):
+        return self._path('cities.json')
+
+    #Age in seconds of a snapshot stored at iStoredAt
+    def age(self, iStoredAt):
+        return self._clock() - iStoredAt
@@ -0,0 +1,236 @@
+#Benchmarks of gmet against the local upstream stand-in (see upstream_standin.py), so that runs are reproducible and comparable:
+#  python -m gmet.tests.benchmark --output bench.json      run them and save the results
+#  python -m gmet.tests.benchmark --compare bench.json     run them again, compare with a saved run and fail on regressions
+#Times are in milliseconds (microseconds for the functions), memory in KiB. Only requestsPerSecond is better when higher.
+
+import io
+import gc
+import sys
+import json
+import time
+import timeit
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from gmet import gmet
+from gmet.tests.upstream_standin import startUpstreamStandin, loadRecording, DEFAULT_DETAIL
+
+#Cities with a getLieux recording, and client addresses all localized by the ipinfo recording
+CITIES = ['Biot', 'Paris', 'Bordeaux', 'Toulouse', 'Eysines', 'Ustaritz']
+CLIENT_IPS = ['93.184.216.{}'.format(i) for i in range(1, 33)]
+
+HIGHER_IS_BETTER = ('requestsPerSecond',)
+REGRESSION_THRESHOLD = 0.2
+
+
+def percentile(iValues, iFraction):
+    aValues = sorted(iValues)
+    return aValues[min(len(aValues) - 1, int(iFraction * len(aValues)))]
+
+#Empty caches, so that the next requests go to the stand-in
+def resetCaches():
+    gmet.forecastCache.clear()
+    gmet.geolocationCache.clear()
+    gmet.pageCache.clear()
+    gmet.cityIndex = gmet.CityIndex(iMaxSize=gmet.CITY_INDEX_SIZE)
+
+#Send the upstream calls to the stand-in. The server is marked configured so that the configuration file and the
+#background prefetch do not change what is measured
+def useStandin(iServer):
+    gmet.IPINFO_URL = iServer.url
+    gmet.METEOFRANCE_URL = iServer.url
+    gmet.upstreamClient.close()
+    gmet.serverConfigured = True
+    resetCaches()
+
+#Half of the requests are localized from the client address, the other half name their city. With iCold, all the caches
+#are emptied before each request so that it makes every upstream call
+def runWebRequest(iIndex, iCold=False):
+    if iCold:
+        resetCaches()
+    if iIndex % 2:
+        return gmet.runWeb(iCity=CITIES[iIndex % len(CITIES)])
+    return gmet.runWeb(iIP=CLIENT_IPS[iIndex % len(CLIENT_IPS)])
+
+#Throughput and latency of runWeb with iConcurrency threads, like the Flask threads of a worker
+def benchRunWeb(iRequests, iConcurrency, iCold=False):
+    def timedRequest(iIndex):
+        aStart = time.perf_counter()
+        try:
+            runWebRequest(iIndex, iCold)
+            aFailed = False
+        except Exception:
+            aFailed = True
+        return time.perf_counter() - aStart, aFailed
+
+    resetCaches()
+    for i in range(2 * len(CITIES)):
+        timedRequest(i)
+    aStart = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=iConcurrency) as aPool:
+        aResults = list(aPool.map(timedRequest, range(iRequests)))
+    aElapsed = time.perf_counter() - aStart
+    aLatencies = [r[0] * 1000 for r in aResults]
+    return {
+        'requestsPerSecond': iRequests / aElapsed,
+        'p50Ms':             percentile(aLatencies, 0.5),
+        'p90Ms':             percentile(aLatencies, 0.9),
+        'p99Ms':             percentile(aLatencies, 0.99),
+        'errors':            sum(1 for r in aResults if r[1])
+        }
+
+#Time per call of iFunc, best and median of iRepeat runs of iNumber calls
+def benchFunction(iFunc, iNumber, iRepeat=5):
+    aTimes = [t / iNumber * 1e6 for t in timeit.repeat(iFunc, number=iNumber, repeat=iRepeat)]
+    return {'bestUs': min(aTimes), 'medianUs': statistics.median(aTimes)}
+
+def benchFunctions(iNumber):
+    aData = loadRecording(DEFAULT_DETAIL)
+    aCleanData = gmet.buildCleanObject(None, aData)
+    aSummaryArgs = gmet.parse(['-s'])
+    aDayArgs = gmet.parse(['0', '1'])
+    return {
+        'buildCleanObject':               benchFunction(lambda: gmet.buildCleanObject(None, aData), iNumber),
+        'formatOutputForTerminalSummary': benchFunction(lambda: gmet.formatOutputForTerminal(aSummaryArgs, aData, io.StringIO()), iNumber),
+        'formatOutputForTerminalDays':    benchFunction(lambda: gmet.formatOutputForTerminal(aDayArgs, aData, io.StringIO()), iNumber),
+        'formatOutputForWeb':             benchFunction(lambda: gmet.formatOutputForWeb(None, aCleanData, CITIES), iNumber)
+        }
+
+#Memory allocated at peak by a cold request, and kept per warm request (should stay near 0, or caches grow unbounded).
+#Each cold request is traced on its own, tracemalloc.reset_peak needing Python 3.9
+def benchMemory(iRequests):
+    resetCaches()
+    runWebRequest(1)
+    gc.collect()
+    aPeaks = []
+    for i in range(iRequests):
+        resetCaches()
+        tracemalloc.start()
+        try:
+            runWebRequest(i, False)
+            aPeaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    tracemalloc.start()
+    try:
+        gc.collect()
+        aBase = tracemalloc.get_traced_memory()[0]
+        for i in range(iRequests):
+            runWebRequest(i, False)
+        gc.collect()
+        aRetained = tracemalloc.get_traced_memory()[0] - aBase
+    finally:
+        tracemalloc.stop()
+    return {
+        'peakKiBPerColdRequest':     statistics.median(aPeaks) / 1024,
+        'retainedKiBPerWarmRequest': aRetained / iRequests / 1024
+        }
+
+#Time of python -m gmet --version, on top of the interpreter startup
+def benchStartup(iRuns):
+    def medianRun(iArgs):
+        aTimes = []
+        for i in range(iRuns):
+            aStart = time.perf_counter()
+            subprocess.run([sys.executable] + iArgs, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            aTimes.append((time.perf_counter() - aStart) * 1000)
+        return statistics.median(aTimes)
+    aInterpreter = medianRun(['-c', 'pass'])
+    return {'interpreterMs': aInterpreter, 'overheadMs': medianRun(['-m', 'gmet', '--version']) - aInterpreter}
+
+def runBenchmarks(iRequests=400, iConcurrency=8, iLatency=0.02, iFailureRate=0.0, iNumber=200, iStartupRuns=5):
+    aServer = startUpstreamStandin(iLatency=iLatency, iFailureRate=iFailureRate)
+    try:
+        useStandin(aServer)
+        aResults = {
+            'runWebWarm': benchRunWeb(iRequests, iConcurrency),
+            'runWebCold': benchRunWeb(max(1, iRequests // 4), iConcurrency, iCold=True),
+            'memory':     benchMemory(max(1, iRequests // 20))
+            }
+        aResults['upstreamCalls'] = {'count': len(aServer.paths)}
+    finally:
+        aServer.stop()
+    aResults.update(benchFunctions(iNumber))
+    if iStartupRuns:
+        aResults['startup'] = benchStartup(iStartupRuns)
+    return aResults
+
+#Rows (benchmark, metric, previous, current, relative change, regressed) for the metrics of both runs
+def compareResults(iPrevious, iCurrent, iThreshold=REGRESSION_THRESHOLD):
+    aRows = []
+    for aBenchmark, aMetrics in iCurrent.items():
+        for aMetric, aValue in aMetrics.items():
+            aPrevious = iPrevious.get(aBenchmark, {}).get(aMetric)
+            if aPrevious is None or aMetric == 'count':
+                continue
+            if aPrevious:
+                aChange = (aValue - aPrevious) / abs(aPrevious)
+            else:
+                aChange = 0.0 if not aValue else float('inf')
+            aWorse = -aChange if aMetric in HIGHER_IS_BETTER else aChange
+            aRows.append((aBenchmark, aMetric, aPrevious, aValue, aChange, aWorse > iThreshold))
+    return aRows
+
+def getCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def parse(iArgs=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of gmet against a local stand-in of the upstream services')
+    parser.add_argument('--requests', '-n', type=int, default=400, help='runWeb requests of the warm benchmark, the cold one sends a quarter of them')
+    parser.add_argument('--concurrency', '-c', type=int, default=8, help='threads sending the runWeb requests')
+    parser.add_argument('--latency', type=float, default=20, help='latency of the stand-in, in milliseconds')
+    parser.add_argument('--failure-rate', dest='failure_rate', type=float, default=0.0, help='fraction of the upstream calls failing with a 503')
+    parser.add_argument('--number', type=int, default=200, help='calls per run of the function benchmarks')
+    parser.add_argument('--startup-runs', dest='startup_runs', type=int, default=5, help='runs of the startup benchmark, 0 to skip it')
+    parser.add_argument('--metrics', default=False, action='store_true', help='enable the metrics of the web server while measuring')
+    parser.add_argument('--output', '-o', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results saved in this JSON file, exit with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='relative change counted as a regression (default 0.2)')
+    return parser.parse_args(iArgs)
+
+def main(iArgs=None):
+    args = parse(iArgs)
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.CRITICAL)
+    gmet.metricsRegistry.enabled = args.metrics
+
+    aSettings = {'requests': args.requests, 'concurrency': args.concurrency, 'latency': args.latency, 'failureRate': args.failure_rate,
+                 'number': args.number, 'metrics': args.metrics}
+    aResults = runBenchmarks(args.requests, args.concurrency, args.latency / 1000, args.failure_rate, args.number, args.startup_runs)
+    aReport = {
+        'date':     time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit':   getCommit(),
+        'python':   platform.python_version(),
+        'machine':  platform.machine(),
+        'settings': aSettings,
+        'results':  aResults
+        }
+    for aBenchmark, aMetrics in aResults.items():
+        for aMetric, aValue in aMetrics.items():
+            print('{:<32} {:<26} {:>12.2f}'.format(aBenchmark, aMetric, aValue))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(aReport, f, indent=1)
+
+    if not args.compare:
+        return 0
+    with open(args.compare) as f:
+        aPrevious = json.load(f)
+    if aPrevious.get('settings') != aSettings:
+        print('Warning: settings differ from {}: {}'.format(args.compare, aPrevious.get('settings')))
+    print('\nCompared with {} ({})'.format(args.compare, aPrevious.get('commit')))
+    aRegressions = 0
+    for aBenchmark, aMetric, aOld, aNew, aChange, aRegressed in compareResults(aPrevious['results'], aResults, args.threshold):
+        aRegressions += aRegressed
+        print('{:<32} {:<26} {:>12.2f} {:>12.2f} {:>+8.1%}{}'.format(aBenchmark, aMetric, aOld, aNew, aChange, '  REGRESSION' if aRegressed else ''))
+    return 1 if aRegressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
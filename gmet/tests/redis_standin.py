@@ -0,0 +1,84 @@
+#Local stand-in for a Redis server, speaking just enough of the protocol for RedisBackend
+
+import time
+import threading
+import socketserver
+
+
+class RedisStandinHandler(socketserver.StreamRequestHandler):
+
+    def readCommand(self):
+        aLine = self.rfile.readline()
+        if not aLine:
+            return None
+        aArgs = []
+        for i in range(int(aLine[1:-2])):
+            aLength = int(self.rfile.readline()[1:-2])
+            aArgs.append(self.rfile.read(aLength + 2)[:-2].decode('utf-8'))
+        return aArgs
+
+    def reply(self, iValue):
+        if iValue is None:
+            self.wfile.write(b'$-1\r\n')
+        elif isinstance(iValue, int):
+            self.wfile.write(b':%d\r\n' % iValue)
+        elif isinstance(iValue, list):
+            self.wfile.write(b'*%d\r\n' % len(iValue))
+            for aItem in iValue:
+                self.reply(aItem)
+        elif iValue == 'OK':
+            self.wfile.write(b'+OK\r\n')
+        else:
+            aBytes = str(iValue).encode('utf-8')
+            self.wfile.write(b'$%d\r\n%s\r\n' % (len(aBytes), aBytes))
+
+    def handle(self):
+        aData = self.server.data
+        while True:
+            aArgs = self.readCommand()
+            if aArgs is None:
+                return
+            aCommand = aArgs[0].upper()
+            with self.server.lock:
+                self.server.commands.append(aCommand)
+                if aCommand in ('PING', 'SELECT'):
+                    self.reply('OK')
+                elif aCommand == 'GET':
+                    aItem = aData.get(aArgs[1])
+                    if aItem is not None and aItem[1] is not None and aItem[1] <= time.time():
+                        aItem = aData.pop(aArgs[1])
+                        aItem = None
+                    self.reply(None if aItem is None else aItem[0])
+                elif aCommand == 'SET':
+                    aExpiresAt = time.time() + int(aArgs[4]) if len(aArgs) > 4 and aArgs[3].upper() == 'EX' else None
+                    aData[aArgs[1]] = (aArgs[2], aExpiresAt)
+                    self.reply('OK')
+                elif aCommand == 'DEL':
+                    self.reply(1 if aData.pop(aArgs[1], None) is not None else 0)
+                elif aCommand == 'HINCRBY':
+                    aHash = aData.setdefault(aArgs[1], {})
+                    aHash[aArgs[2]] = aHash.get(aArgs[2], 0) + int(aArgs[3])
+                    self.reply(aHash[aArgs[2]])
+                elif aCommand == 'HSET':
+                    aData.setdefault(aArgs[1], {})[aArgs[2]] = int(aArgs[3])
+                    self.reply(1)
+                elif aCommand == 'HDEL':
+                    self.reply(1 if aData.get(aArgs[1], {}).pop(aArgs[2], None) is not None else 0)
+                elif aCommand == 'HGETALL':
+                    aItems = []
+                    for aField, aCount in aData.get(aArgs[1], {}).items():
+                        aItems += [aField, str(aCount)]
+                    self.reply(aItems)
+                else:
+                    self.wfile.write(b'-ERR unknown command\r\n')
+
+
+#Start a stand-in on a free local port, stop it with shutdown() and server_close()
+def startRedisStandin():
+    aServer = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RedisStandinHandler)
+    aServer.daemon_threads = True
+    aServer.data = {}
+    aServer.commands = []
+    aServer.lock = threading.Lock()
+    threading.Thread(target=aServer.serve_forever, daemon=True).start()
+    return aServer
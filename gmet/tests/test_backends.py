@@ -0,0 +1,89 @@
+import pytest
+from gmet.backends import MemoryBackend, SqliteBackend, RedisBackend, CacheBackendError, createBackend
+from gmet.cache import TTLCache
+from gmet.cityindex import CityIndex
+from gmet.tests.redis_standin import startRedisStandin
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        yield MemoryBackend()
+    elif request.param == 'sqlite':
+        aBackend = SqliteBackend(str(tmp_path / 'cache.db'))
+        yield aBackend
+        aBackend.close()
+    else:
+        aServer = startRedisStandin()
+        aBackend = RedisBackend('127.0.0.1', aServer.server_address[1])
+        yield aBackend
+        aBackend.close()
+        aServer.shutdown()
+        aServer.server_close()
+
+
+def test_backend_values(backend):
+    assert backend.get('forecast:060180') is None
+    backend.set('forecast:060180', '{"nom": "Biot"}', 60)
+    assert backend.get('forecast:060180') == '{"nom": "Biot"}'
+    backend.set('forecast:060180', 'expired', -1)
+    assert backend.get('forecast:060180') is None
+    backend.delete('forecast:060180')
+    assert backend.get('forecast:060180') is None
+
+def test_backend_counters(backend):
+    assert backend.incr('requests', 'Biot') == 1
+    assert backend.incr('requests', 'Biot') == 2
+    backend.incr('requests', 'Toulouse', 5)
+    assert backend.getCounters('requests') == {'Biot': 2, 'Toulouse': 5}
+    backend.setCounter('requests', 'Biot', 7)
+    backend.deleteCounter('requests', 'Toulouse')
+    assert backend.getCounters('requests') == {'Biot': 7}
+
+def test_sqlite_backend_purge(tmp_path):
+    aBackend = SqliteBackend(str(tmp_path / 'cache.db'), iMaxEntries=2)
+    for i in range(4):
+        aBackend.set('k{}'.format(i), 'v', 60 + i)
+    aBackend.purge()
+    assert aBackend.get('k0') is None
+    assert aBackend.get('k3') == 'v'
+
+def test_ttlcache_shared_between_workers(tmp_path):
+    aPath = str(tmp_path / 'cache.db')
+    worker1 = TTLCache(iTTL=60, iName='forecast', iBackend=SqliteBackend(aPath))
+    worker2 = TTLCache(iTTL=60, iName='forecast', iBackend=SqliteBackend(aPath))
+    worker1.set('060180', {'nom': 'Biot'})
+    assert worker2.get('060180', lambda: pytest.fail('upstream called')) == {'nom': 'Biot'}
+    assert worker2.stats()['sharedHits'] == 1
+    assert worker2.getEntry('060180', None).modifiedAt == worker1.getEntry('060180', None).modifiedAt
+
+def test_expiresIn_reads_the_shared_entry(tmp_path):
+    aPath = str(tmp_path / 'cache.db')
+    worker1 = TTLCache(iTTL=60, iName='forecast', iBackend=SqliteBackend(aPath))
+    worker2 = TTLCache(iTTL=60, iName='forecast', iBackend=SqliteBackend(aPath))
+    worker2.set('060180', {'nom': 'Biot'}, 5)
+    assert worker1.expiresIn('060180') <= 5
+    worker1.set('060180', {'nom': 'Biot'})
+    assert worker2.expiresIn('060180') > 50
+
+def test_cityindex_shared_between_workers():
+    backend = MemoryBackend()
+    CityIndex(iBackend=backend).add('Biot', [{'indicatif': '060180', 'nom': 'Biot', 'codePostal': '06410', 'nomDept': 'Alpes-Maritimes', 'numDept': '06', 'pays': 'France'}])
+    other = CityIndex(iBackend=backend)
+    assert other.lookup('biot')[0]['indicatif'] == '060180'
+    assert other.lookupInsee('060180')[1] == 'Biot'
+
+def test_unavailable_redis_does_not_break_the_cache():
+    cache = TTLCache(iTTL=60, iName='forecast', iBackend=RedisBackend('127.0.0.1', 1))
+    assert cache.get('060180', lambda: 'fetched') == 'fetched'
+    assert cache.get('060180', lambda: 'refetched') == 'fetched'
+    assert cache.stats()['backendErrors'] > 0
+    with pytest.raises(CacheBackendError):
+        RedisBackend('127.0.0.1', 1).get('x')
+
+def test_createBackend(tmp_path):
+    assert isinstance(createBackend('memory'), MemoryBackend)
+    assert isinstance(createBackend('sqlite://' + str(tmp_path / 'cache.db')), SqliteBackend)
+    assert createBackend('redis://cache:6380/2').port == 6380
+    with pytest.raises(ValueError):
+        createBackend('memcached://cache')
@@ -0,0 +1,29 @@
+import json
+from gmet import gmet
+from gmet.tests import benchmark
+
+
+def test_compareResults():
+    previous = {'runWebWarm': {'requestsPerSecond': 100.0, 'p50Ms': 10.0, 'errors': 0}, 'startup': {'overheadMs': 80.0}}
+    current = {'runWebWarm': {'requestsPerSecond': 70.0, 'p50Ms': 11.0, 'errors': 1}, 'memory': {'peakKiBPerColdRequest': 90.0}}
+    rows = {(r[0], r[1]): r for r in benchmark.compareResults(previous, current, 0.2)}
+    assert sorted(rows) == [('runWebWarm', 'errors'), ('runWebWarm', 'p50Ms'), ('runWebWarm', 'requestsPerSecond')]
+    assert rows[('runWebWarm', 'requestsPerSecond')][5]
+    assert not rows[('runWebWarm', 'p50Ms')][5]
+    assert rows[('runWebWarm', 'errors')][5]
+
+def test_benchmark_run_and_compare(monkeypatch, tmp_path):
+    for aName in ('IPINFO_URL', 'METEOFRANCE_URL', 'serverConfigured', 'cityIndex', 'forecastCache', 'geolocationCache', 'pageCache'):
+        monkeypatch.setattr(gmet, aName, getattr(gmet, aName))
+    monkeypatch.setattr(gmet, 'upstreamClient', gmet.UpstreamClient())
+    monkeypatch.setattr(gmet.metricsRegistry, 'enabled', gmet.metricsRegistry.enabled)
+    output = str(tmp_path / 'bench.json')
+    arguments = ['--requests', '20', '--concurrency', '4', '--latency', '0', '--number', '2', '--startup-runs', '0']
+    assert benchmark.main(arguments + ['--output', output]) == 0
+    with open(output) as f:
+        report = json.load(f)
+    assert report['results']['runWebWarm']['errors'] == 0
+    assert report['results']['runWebCold']['errors'] == 0
+    assert report['results']['upstreamCalls']['count'] > 0
+    assert set(report['results']) >= {'memory', 'buildCleanObject', 'formatOutputForTerminalSummary', 'formatOutputForWeb'}
+    assert benchmark.main(arguments + ['--compare', output, '--threshold', '1000']) == 0
@@ -0,0 +1,82 @@
+from gmet.cache import TTLCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttlcache_hit_and_miss():
+    clock = FakeClock()
+    cache = TTLCache(iTTL=10, iMaxSize=4, iClock=clock)
+    calls = []
+    loader = lambda: calls.append(1) or len(calls)
+    assert cache.get('060180', loader) == 1
+    assert cache.get('060180', loader) == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    clock.now += 11
+    assert cache.get('060180', loader) == 2
+    assert cache.stats()['misses'] == 2
+
+def test_ttlcache_modifiedAt_kept_while_version_unchanged():
+    clock = FakeClock()
+    cache = TTLCache(iTTL=10, iClock=clock, iVersionFunc=lambda v: v['version'])
+    cache.set('060180', {'version': 1})
+    clock.now += 11
+    assert cache.getEntry('060180', lambda: {'version': 1}).modifiedAt == 1000.0
+    clock.now += 11
+    aEntry = cache.getEntry('060180', lambda: {'version': 2})
+    assert aEntry.modifiedAt == aEntry.storedAt == 1022.0
+
+def test_ttlcache_lru_eviction():
+    cache = TTLCache(iTTL=10, iMaxSize=2, iClock=FakeClock())
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a', lambda: 0)
+    cache.set('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.stats()['evictions'] == 1
+
+def test_ttlcache_stale_while_revalidate():
+    clock = FakeClock()
+    cache = TTLCache(iTTL=10, iMaxSize=4, iStaleTTL=100, iClock=clock)
+    cache.set('060180', 'old')
+    clock.now += 50
+    assert cache.get('060180', lambda: 'new') == 'old'
+    cache.waitRefreshes()
+    assert cache.peek('060180') == 'new'
+    assert cache.stats()['staleHits'] == 1
+    assert cache.stats()['refreshes'] == 1
+
+def test_ttlcache_failed_refresh_keeps_stale_value():
+    clock = FakeClock()
+    cache = TTLCache(iTTL=10, iMaxSize=4, iStaleTTL=100, iClock=clock)
+    cache.set('060180', 'old')
+    clock.now += 50
+    def failing():
+        raise IOError('upstream down')
+    assert cache.get('060180', failing) == 'old'
+    cache.waitRefreshes()
+    assert cache.peek('060180') == 'old'
+    assert cache.stats()['refreshErrors'] == 1
+
+def test_ttlcache_keep_expired_serves_last_good_value():
+    clock = FakeClock()
+    cache = TTLCache(iTTL=10, iMaxSize=4, iStaleTTL=100, iClock=clock, iKeepExpired=True)
+    cache.set('060180', 'old')
+    clock.now += 500
+    def failing():
+        raise IOError('upstream down')
+    assert cache.get('060180', failing) == 'old'
+    assert cache.stats()['degradedHits'] == 1
+    assert cache.get('060180', lambda: 'new') == 'new'
+    try:
+        cache.get('330630', failing)
+        assert False, 'nothing to serve without a previous value'
+    except IOError:
+        pass
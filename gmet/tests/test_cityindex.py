@@ -0,0 +1,58 @@
+import pytest
+from gmet import gmet
+from gmet.cityindex import CityIndex, normalizeCityName
+
+BORDEAUX = [
+    {'indicatif': '330630', 'nom': 'Bordeaux', 'codePostal': '33000', 'nomDept': 'Gironde', 'numDept': '33', 'pays': 'France', 'lat': 44.8},
+    {'indicatif': '330630', 'nom': 'Bordeaux', 'codePostal': '33100', 'nomDept': 'Gironde', 'numDept': '33', 'pays': 'France', 'lat': 44.8},
+    {'indicatif': '450410', 'nom': 'Bordeaux-en-Gâtinais', 'codePostal': '45340', 'nomDept': 'Loiret', 'numDept': '45', 'pays': 'France', 'lat': 48.1}
+    ]
+
+
+def test_normalizeCityName():
+    assert normalizeCityName('  Èze ') == 'eze'
+    assert normalizeCityName('Bordeaux-en-Gâtinais') == normalizeCityName('bordeaux-en-gatinais')
+
+def test_cityindex_snapshot(tmp_path):
+    index = CityIndex()
+    index.add('Bordeaux', BORDEAUX)
+    assert index.save(str(tmp_path / 'cities.json'))
+    other = CityIndex()
+    assert other.load(str(tmp_path / 'cities.json')) == 1
+    assert other.lookup('BORDEAUX')[2]['indicatif'] == '450410'
+    assert other.lookupInsee('450410') == ['450410', 'Bordeaux-en-Gâtinais', '45340', 'Loiret', '45', 'France']
+
+def test_getInseeCode_through_index(monkeypatch):
+    calls = []
+    def getLieux(iCityName):
+        calls.append(iCityName)
+        return BORDEAUX if iCityName.lower() == 'bordeaux' else []
+    monkeypatch.setattr(gmet, 'cityIndex', CityIndex())
+    monkeypatch.setattr(gmet, 'getLieuxFromMeteoFranceAPI', getLieux)
+    assert gmet.getInseeCode('bordeaux')[0] == '330630'
+    assert gmet.getInseeCode('Bordeaux', '450410')[0] == '450410'
+    with pytest.raises(ValueError):
+        gmet.getInseeCode('bordeaux', '993366')
+    with pytest.raises(ValueError):
+        gmet.getInseeCode('nomatch')
+    with pytest.raises(ValueError):
+        gmet.getInseeCode('NoMatch')
+    assert calls == ['bordeaux', 'nomatch']
+
+def test_unknown_names_expire_and_stay_local(tmp_path):
+    from gmet.backends import MemoryBackend
+    now = [0.0]
+    backend = MemoryBackend()
+    index = CityIndex(iMaxSize=2, iBackend=backend, iUnknownTTL=60, iMaxUnknown=2, iClock=lambda: now[0])
+    index.add('Bordeaux', BORDEAUX)
+    for aName in ['wp-login.php', 'admin', '.env']:
+        assert index.add(aName, []) == []
+    assert index.lookup('Bordeaux')[0]['indicatif'] == '330630'
+    assert index.lookup('.env') == []
+    assert index.lookup('wp-login.php') is None
+    assert index.stats()['unknownNames'] == 2
+    assert backend.get('city:.env') is None
+    index.save(str(tmp_path / 'cities.json'))
+    assert CityIndex().load(str(tmp_path / 'cities.json')) == 1
+    now[0] = 61
+    assert index.lookup('.env') is None
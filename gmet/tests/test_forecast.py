@@ -0,0 +1,30 @@
+import os
+import json
+from gmet.forecast import normalizeForecast, parseKey
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+def loadData(iName):
+    with open(os.path.join(DATA_DIR, iName), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_parseKey():
+    assert parseKey('3_matin') == (3, 'matin')
+    assert parseKey('0_07-10') == (0, '07-10')
+    assert parseKey('ville') is None
+    assert parseKey('x_resume') is None
+
+def test_normalizeForecast_structure():
+    forecast = normalizeForecast(loadData('getDetail_060180.json'))
+    assert forecast.ville['nom'] == 'Biot'
+    assert [d.index for d in forecast.days] == list(range(10))
+    assert [p.name for p in forecast.days[0].periods] == ['matin', 'midi', 'soir', 'nuit']
+    assert [r.timerange for r in forecast.days[0].periods[3].timeranges] == ['22-01', '01-04', '04-07']
+    assert forecast.days[2].periods[0].timeranges == []
+    assert forecast.days[9].periods == []
+
+def test_normalizeForecast_is_not_bounded_to_100_days():
+    data = {'result': {'ville': {}, 'previsions': {}, 'previsions48h': {},
+                       'resumes': {'150_resume': {'date': 0, 'description': 'Ensoleillé', 'temperatureMin': 1, 'temperatureMax': 2}, 'bogus': {}}}}
+    assert [d.index for d in normalizeForecast(data).days] == [150]
@@ -1,5 +1,19 @@
+import os
+import json
+import time
 import pytest
 from gmet import gmet
+from gmet.cityindex import CITY_FIELDS
+from gmet.upstream import UpstreamError
+from gmet.tests.upstream_standin import startUpstreamStandin
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+def loadData(iName):
+    with open(os.path.join(DATA_DIR, iName), encoding='utf-8') as f:
+        return json.load(f)
+
+BIOT = ['060180', 'Biot', '06410', 'Alpes-Maritimes', '06', 'France']
 
 def test_getInseeCode():
         assert gmet.getInseeCode("paris")[0] == "750560"
@@ -13,4 +27,316 @@ def test_getInseeCode_exception1():
 
 def test_getInseeCode_exception2():
     with pytest.raises(ValueError):
-        gmet.getInseeCode("bordeaux", "993366")
\ No newline at end of file
+        gmet.getInseeCode("bordeaux", "993366")
+
+def test_localize_cache_by_prefix(monkeypatch):
+    calls = []
+    def ipinfo(iIP=None):
+        calls.append(iIP)
+        return {'ip': iIP, 'city': 'Biot', 'postal': '06410', 'country': 'FR'}
+    monkeypatch.setattr(gmet, 'geolocationCache', gmet.TTLCache(iTTL=60, iMaxSize=16))
+    monkeypatch.setattr(gmet, 'getLocationFromIpinfoAPI', ipinfo)
+    assert gmet.localize('82.64.10.1')['city'] == 'Biot'
+    assert gmet.localize('82.64.10.1')['city'] == 'Biot'
+    assert gmet.localize('82.64.10.200')['ip'] == '82.64.10.200'
+    assert calls == ['82.64.10.1']
+
+def test_localize_bogon_is_local(monkeypatch):
+    def ipinfo(iIP=None):
+        raise AssertionError('no network call expected')
+    monkeypatch.setattr(gmet, 'getLocationFromIpinfoAPI', ipinfo)
+    assert 'bogon' in gmet.localize('10.1.2.3')
+    assert 'bogon' in gmet.localize('not-an-ip')
+
+def test_localize_negative_cache(monkeypatch):
+    calls = []
+    def ipinfo(iIP=None):
+        calls.append(iIP)
+        raise IOError('ipinfo down')
+    monkeypatch.setattr(gmet, 'geolocationCache', gmet.TTLCache(iTTL=60, iMaxSize=16))
+    monkeypatch.setattr(gmet, 'getLocationFromIpinfoAPI', ipinfo)
+    for i in range(3):
+        with pytest.raises(IOError):
+            gmet.localize('82.64.10.1')
+    assert len(calls) == 1
+
+def test_outputTemplate_built_once():
+    assert gmet.getOutputTemplate() is gmet.getOutputTemplate()
+
+def test_executeWeb_page_cache(monkeypatch):
+    fetches = []
+    builds = []
+    def getDetail(iCityInseeCode):
+        fetches.append(iCityInseeCode)
+        return loadData('getDetail_060180.json')
+    buildCleanObject = gmet.buildCleanObject
+    def countingBuild(iConfig, iData, iStoredAt=None):
+        builds.append(1)
+        return buildCleanObject(iConfig, iData, iStoredAt)
+    monkeypatch.setattr(gmet, 'forecastCache', gmet.TTLCache(iTTL=60, iVersionFunc=gmet.getForecastVersion))
+    monkeypatch.setattr(gmet, 'pageCache', gmet.TTLCache(iTTL=60))
+    monkeypatch.setattr(gmet, 'serverConfigured', True)
+    monkeypatch.setattr(gmet, 'requestTracker', gmet.FrequentTracker(gmet.MemoryBackend()))
+    monkeypatch.setattr(gmet, 'getInseeCode', lambda iCityName, iInseeCode=None: list(BIOT))
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', getDetail)
+    monkeypatch.setattr(gmet, 'buildCleanObject', countingBuild)
+    monkeypatch.setattr(gmet, 'getFavorites', lambda: ['Biot'])
+    first = gmet.runWeb(iCity='Biot')
+    assert 'Biot' in first
+    assert gmet.runWeb(iCity='Biot') == first
+    assert fetches == ['060180']
+    assert len(builds) == 1
+
+def test_formatFrenchDate():
+    assert gmet.formatFrenchDate(1590969600000) == 'lun. - 01 juin'
+    assert gmet.formatFrenchDate(1597536000000) == 'dim. - 16 août'
+    assert gmet.formatFrenchDate(1608854400000) == 'ven. - 25 déc.'
+
+def test_buildCleanObject_shows_fetch_time(monkeypatch):
+    monkeypatch.setattr(gmet, 'forecastCache', gmet.TTLCache(iTTL=60, iVersionFunc=gmet.getForecastVersion, iClock=lambda: 0.0))
+    monkeypatch.setattr(gmet, 'pageCache', gmet.TTLCache(iTTL=60))
+    monkeypatch.setattr(gmet, 'serverConfigured', True)
+    monkeypatch.setattr(gmet, 'getInseeCode', lambda iCityName, iInseeCode=None: list(BIOT))
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', lambda iCityInseeCode: loadData('getDetail_060180.json'))
+    fetchedAt = gmet.datetime.datetime.fromtimestamp(0.0).strftime("%H:%M %d%b")
+    assert gmet.runApi('Biot')[0]['meteoDateTime'] == fetchedAt
+
+def test_buildCleanObject():
+    cleanData = gmet.buildCleanObject(None, loadData('getDetail_060180.json'))
+    assert cleanData['nom'] == 'Biot'
+    assert len(cleanData['previsions']) == 10
+    assert cleanData['previsions'][0]['date'] == 'lun. - 01 juin'
+    assert [r['_timerange'] for r in cleanData['previsions'][0]['timeranges']] == ['07-10h', '10-13h', '13-16h', '16-19h', '19-22h', '22-01h', '01-04h', '04-07h']
+    assert [r['_timerange'] for r in cleanData['previsions'][2]['timeranges']] == ['matin', 'midi', 'soir', 'nuit']
+
+def test_forecastNeedsRefresh(monkeypatch):
+    monkeypatch.setattr(gmet, 'forecastCache', gmet.TTLCache(iTTL=600))
+    monkeypatch.setattr(gmet, 'prefetchScheduler', gmet.PrefetchScheduler(None, None, None, iInterval=60))
+    assert gmet.forecastNeedsRefresh('060180')
+    gmet.forecastCache.set('060180', {})
+    assert not gmet.forecastNeedsRefresh('060180')
+    gmet.forecastCache.set('060180', {}, 100)
+    assert gmet.forecastNeedsRefresh('060180')
+
+def test_favorites_reloaded_when_config_changes(monkeypatch, tmp_path):
+    config = tmp_path / 'config.ini'
+    config.write_text('favorites = Toulouse, Biot\n')
+    monkeypatch.setattr(gmet, 'CONFIG_FILE', str(config))
+    monkeypatch.setattr(gmet, 'configMtime', None)
+    monkeypatch.setattr(gmet, 'configValues', {})
+    assert gmet.getFavorites() == ['Toulouse', 'Biot']
+    config.write_text('favorites = Biot, Eysines, Toulouse, Ustaritz\n')
+    os.utime(str(config), ns=(0, 10**9))
+    assert gmet.getFavorites() == ['Biot', 'Eysines', 'Toulouse', 'Ustaritz']
+
+def test_getFrequentRequests(monkeypatch):
+    monkeypatch.setattr(gmet, 'requestTracker', gmet.FrequentTracker(gmet.MemoryBackend()))
+    monkeypatch.setattr(gmet, 'getFavorites', lambda: ['Toulouse', 'Biot'])
+    for aCity in ['Paris', 'Biot', 'Paris', 'Lyon']:
+        gmet.cacheCityRequested(aCity)
+    assert gmet.getFrequentRequests() == ['Toulouse', 'Biot', 'Paris', 'Lyon']
+
+def test_parseBatchEntry():
+    assert gmet.parseBatchEntry('Biot') == ('Biot', None)
+    assert gmet.parseBatchEntry('060180') == (None, '060180')
+    assert gmet.parseBatchEntry(' Bordeaux , 450410') == ('Bordeaux', '450410')
+
+def test_executeBatch(monkeypatch, tmp_path, capsys):
+    def getInseeCode(iCityName, iInseeCode=None):
+        if iCityName == 'nomatch':
+            raise ValueError('Unknown Input City name: nomatch')
+        return list(BIOT)
+    monkeypatch.setattr(gmet, 'forecastCache', gmet.TTLCache(iTTL=60))
+    monkeypatch.setattr(gmet, 'getInseeCode', getInseeCode)
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', lambda iCityInseeCode: loadData('getDetail_060180.json'))
+    cities = tmp_path / 'cities.txt'
+    cities.write_text('# dashboard cities\n060180\n\nnomatch\n')
+    with pytest.raises(ValueError):
+        gmet.executeScript(gmet.parse(['--json', '--cities', 'Biot', '--file', str(cities)]))
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(l)['nom'] for l in lines] == ['Biot', 'Biot']
+
+@pytest.fixture
+def offline(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmet, 'snapshotStore', None)
+    monkeypatch.setattr(gmet, 'cityIndex', gmet.CityIndex())
+    monkeypatch.setenv('GMET_CACHE_DIR', str(tmp_path))
+    refreshes = []
+    monkeypatch.setattr(gmet, 'startSnapshotRefresh', refreshes.append)
+    return refreshes
+
+def test_executeScript_falls_back_to_snapshot(monkeypatch, offline, capsys):
+    monkeypatch.setattr(gmet, 'getLieuxFromMeteoFranceAPI', lambda iCityName: [dict(zip(CITY_FIELDS, BIOT))])
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', lambda iCityInseeCode: loadData('getDetail_060180.json'))
+    gmet.executeScript(gmet.parse(['-c', 'Biot', '0']))
+    assert 'Stale' not in capsys.readouterr().out
+
+    def unreachable(*iArgs):
+        raise IOError('upstream down')
+    monkeypatch.setattr(gmet, 'snapshotStore', None)
+    monkeypatch.setattr(gmet, 'cityIndex', gmet.CityIndex())
+    monkeypatch.setattr(gmet, 'getLieuxFromMeteoFranceAPI', unreachable)
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', unreachable)
+    gmet.executeScript(gmet.parse(['-c', 'biot', '0']))
+    out = capsys.readouterr().out
+    assert 'Stale forecast' in out
+    assert 'Biot' in out
+
+def test_executeScript_fast_mode(monkeypatch, offline, capsys):
+    monkeypatch.setattr(gmet, 'getLieuxFromMeteoFranceAPI', lambda iCityName: [dict(zip(CITY_FIELDS, BIOT))])
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', lambda iCityInseeCode: loadData('getDetail_060180.json'))
+    gmet.executeScript(gmet.parse(['-c', 'Biot']))
+    capsys.readouterr()
+
+    def unreachable(*iArgs):
+        raise AssertionError('no network call expected')
+    monkeypatch.setattr(gmet, 'snapshotStore', None)
+    monkeypatch.setattr(gmet, 'cityIndex', gmet.CityIndex())
+    monkeypatch.setattr(gmet, 'getLieuxFromMeteoFranceAPI', unreachable)
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', unreachable)
+    monkeypatch.setattr(gmet, 'SNAPSHOT_REFRESH_AGE', -1)
+    gmet.executeScript(gmet.parse(['-c', 'Biot', '--fast']))
+    assert 'refreshing in background' in capsys.readouterr().out
+    assert len(offline) == 1
+
+def test_getDescriptionColor():
+    assert gmet.getDescriptionColor('Pluie faible') == gmet.CBLUE
+    assert gmet.getDescriptionColor('Averses orageuses') == gmet.CBLUE
+    assert gmet.getDescriptionColor('Ensoleillé') == gmet.CORANGE
+    assert gmet.getDescriptionColor('Soleil et averses') == gmet.CORANGE
+    assert gmet.getDescriptionColor('Très nuageux') == gmet.CGREEN
+
+def test_formatOutputForTerminal_single_write():
+    class Output(object):
+        def __init__(self):
+            self.writes = []
+        def write(self, iText):
+            self.writes.append(iText)
+        def flush(self):
+            pass
+    aOutput = Output()
+    gmet.formatOutputForTerminal(gmet.parse(['-s']), loadData('getDetail_060180.json'), aOutput)
+    assert len(aOutput.writes) == 1
+    assert aOutput.writes[0].splitlines() == gmet.renderTerminal(gmet.parse(['-s']), loadData('getDetail_060180.json'))
+
+def test_formatScreenUpdate():
+    assert gmet.formatScreenUpdate(None, ['a', 'b']) == '\033[H\033[2Ja\nb\n'
+    assert gmet.formatScreenUpdate(['a', 'b', 'c'], ['a', 'B', 'c']) == '\033[2;1HB\033[K\033[4;1H'
+    assert gmet.formatScreenUpdate(['a', 'b', 'c'], ['a']) == '\033[2;1H\033[K\033[3;1H\033[K\033[2;1H'
+    assert gmet.formatScreenUpdate(['a'], ['a']) == '\033[2;1H'
+
+def test_executeWatch_redraws_changed_lines(monkeypatch, offline, capsys):
+    data = loadData('getDetail_060180.json')
+    changed = loadData('getDetail_060180.json')
+    changed['result']['resumes']['0_resume']['description'] = 'Soleil'
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', lambda iCityInseeCode: changed)
+    monkeypatch.setattr(gmet.time, 'sleep', lambda iSeconds: None)
+    gmet.executeWatch(gmet.parse(['-s', '--watch', '1']), '060180', data, iCount=1)
+    first, separator, update = capsys.readouterr().out.partition('\033[2;1H')
+    assert first.startswith('\033[H\033[2J')
+    #The day line, and the time of the update when the clock changed meanwhile
+    assert update.startswith(gmet.CORANGE + 'Mon-01Jun | Soleil ')
+    assert 1 <= update.count('\033[K') <= 2
+
+#Upstream calls answered by the local stand-in replaying the recordings of the data directory, with fresh caches
+@pytest.fixture
+def replay(monkeypatch):
+    aServer = startUpstreamStandin()
+    monkeypatch.setattr(gmet, 'IPINFO_URL', aServer.url)
+    monkeypatch.setattr(gmet, 'METEOFRANCE_URL', aServer.url)
+    monkeypatch.setattr(gmet, 'upstreamClient', gmet.UpstreamClient())
+    monkeypatch.setattr(gmet, 'cityIndex', gmet.CityIndex())
+    monkeypatch.setattr(gmet, 'forecastCache', gmet.TTLCache(iTTL=60, iName='forecast', iVersionFunc=gmet.getForecastVersion, iKeepExpired=True))
+    monkeypatch.setattr(gmet, 'geolocationCache', gmet.TTLCache(iTTL=60, iName='geolocation'))
+    monkeypatch.setattr(gmet, 'pageCache', gmet.TTLCache(iTTL=60, iName='page'))
+    monkeypatch.setattr(gmet, 'serverConfigured', True)
+    yield aServer
+    aServer.stop()
+
+def test_getInseeCode_replayed(replay):
+    assert gmet.getInseeCode("paris")[0] == "750560"
+    assert gmet.getInseeCode("paris", "751070")[0] == "751070"
+    assert gmet.getInseeCode("bordeaux")[0] == "330630"
+    assert gmet.getInseeCode("bordeaux", "450410")[0] == "450410"
+    with pytest.raises(ValueError):
+        gmet.getInseeCode("nomatch")
+    with pytest.raises(ValueError):
+        gmet.getInseeCode("bordeaux", "993366")
+
+def test_runWeb_replayed(replay):
+    assert 'Biot' in gmet.runWeb(iIP='93.184.216.34')
+    assert replay.paths == ['/93.184.216.34', '/getLieux/Biot.json', '/getDetail/france/060180.json']
+    assert 'Biot' in gmet.runWeb(iIP='93.184.216.35')
+    assert len(replay.paths) == 3
+
+def test_upstream_failure_injected(replay):
+    replay.failureRate = 1
+    with pytest.raises(IOError):
+        gmet.runApi('Toulouse')
+    replay.failureRate = 0
+    assert gmet.runApi('Toulouse')[0]['nom'] == 'Toulouse'
+
+def test_runApi_serves_last_known_forecast_when_upstream_down(replay, monkeypatch):
+    monkeypatch.setattr(gmet, 'upstreamClient', gmet.UpstreamClient(iBackoff=0.01, iBreakerFailures=3))
+    assert gmet.runApi('Biot')[0]['nom'] == 'Biot'
+    gmet.forecastCache.configure(iTTL=0, iStaleTTL=0)
+    replay.failureRate = 1
+    for i in range(5):
+        assert gmet.runApi('Biot')[0]['nom'] == 'Biot'
+    assert gmet.forecastCache.stats()['degradedHits'] == 5
+    #Three failed calls opened the breaker, the next requests did not reach the upstream
+    assert len(replay.paths) == 2 + 3
+    host = replay.url[len('http://'):]
+    assert gmet.getCacheStats()['upstream']['hosts'][host]['breaker'] == 'open'
+    assert 'gmet_upstream_breaker_state{{host="{}"}} 2'.format(host) in gmet.metricsRegistry.render()
+
+def test_executeWeb_falls_back_to_known_paris(replay, monkeypatch):
+    monkeypatch.setattr(gmet, 'upstreamClient', gmet.UpstreamClient(iBackoff=0.01))
+    assert 'Paris' in gmet.runWeb(iCity='Nowhere')
+    replay.failureRate = 1
+    assert 'Paris' in gmet.runWeb(iCity='Elsewhere')
+    assert replay.paths.count('/getLieux/Paris.json') == 1
+
+def test_executeWeb_does_not_ask_getLieux_for_paris_when_down(replay, monkeypatch):
+    monkeypatch.setattr(gmet, 'upstreamClient', gmet.UpstreamClient(iBackoff=0.01))
+    replay.failureRate = 1
+    with pytest.raises(IOError):
+        gmet.runWeb(iCity='Nowhere')
+    assert '/getLieux/Paris.json' not in replay.paths
+
+def test_executeWeb_shows_paris_when_ipinfo_has_no_city(replay, monkeypatch):
+    monkeypatch.setattr(gmet, 'getLocationFromIpinfoAPI', lambda iIP=None: {'ip': iIP, 'country': 'FR'})
+    assert 'Paris' in gmet.runWeb(iIP='93.184.216.34')
+
+def test_executeWeb_asks_getLieux_for_paris_when_name_rejected(replay, monkeypatch):
+    getInseeCode = gmet.getInseeCode
+    def rejectNowhere(iCityName, iInseeCode=None):
+        if iCityName == 'Nowhere':
+            raise UpstreamError('HTTP 400 from getLieux', 400)
+        return getInseeCode(iCityName, iInseeCode)
+    monkeypatch.setattr(gmet, 'getInseeCode', rejectNowhere)
+    assert 'Paris' in gmet.runWeb(iCity='Nowhere')
+    assert '/getLieux/Paris.json' in replay.paths
+
+def test_runWebBatch_bounded_by_the_request_deadline(replay, monkeypatch):
+    monkeypatch.setattr(gmet, 'requestDeadline', 0.2)
+    replay.latency = 0.5
+    start = time.monotonic()
+    lines = [json.loads(l) for l in gmet.runWebBatch(['060180', '330630', '315550'])]
+    assert time.monotonic() - start < 1
+    assert [l['city'] for l in lines if 'error' in l] and not [l for l in lines if 'forecast' in l]
+
+def test_fetchBatch_cancels_pending_fetches_when_closed(monkeypatch):
+    started = []
+    def slowFetch(iEntry, iDeadline=None):
+        started.append(iEntry)
+        time.sleep(0.2)
+        return iEntry
+    monkeypatch.setattr(gmet, 'getForecastForEntry', slowFetch)
+    batch = gmet.fetchBatch(['c{}'.format(i) for i in range(20)], iJobs=2, iOrdered=True)
+    assert next(batch)[0] == 'c0'
+    start = time.monotonic()
+    batch.close()
+    assert time.monotonic() - start < 0.2
+    time.sleep(0.3)
+    assert len(started) <= 4
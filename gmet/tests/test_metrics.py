@@ -0,0 +1,71 @@
+import time
+from gmet.metrics import MetricsRegistry, RequestProfiler
+
+
+def test_disabled_registry_records_nothing():
+    registry = MetricsRegistry()
+    counter = registry.counter('c_total', 'C')
+    histogram = registry.histogram('h_seconds', 'H', ('stage',))
+    counter.inc()
+    histogram.observe(0.5, ('a',))
+    assert histogram.timed('b')(lambda x: x + 1)(1) == 2
+    assert registry.render() == '# HELP c_total C\n# TYPE c_total counter\n# HELP h_seconds H\n# TYPE h_seconds histogram\n'
+
+def test_histogram_render():
+    registry = MetricsRegistry(iEnabled=True)
+    histogram = registry.histogram('h_seconds', 'H', ('stage',), iBuckets=(0.1, 1))
+    histogram.observe(0.05, ('a',))
+    histogram.observe(0.1, ('a',))
+    histogram.observe(2, ('a',))
+    assert histogram.render()[2:] == [
+        'h_seconds_bucket{stage="a",le="0.1"} 2',
+        'h_seconds_bucket{stage="a",le="1"} 2',
+        'h_seconds_bucket{stage="a",le="+Inf"} 3',
+        'h_seconds_sum{stage="a"} 2.15',
+        'h_seconds_count{stage="a"} 3'
+        ]
+
+def test_timed_observes_failures_too():
+    registry = MetricsRegistry(iEnabled=True)
+    histogram = registry.histogram('h_seconds', 'H', ('stage',))
+    @histogram.timed('fail')
+    def fail():
+        raise ValueError('no')
+    try:
+        fail()
+    except ValueError:
+        pass
+    assert 'h_seconds_count{stage="fail"} 1' in histogram.render()
+
+def test_counter_gauge_and_collected():
+    snapshots = []
+    registry = MetricsRegistry(iEnabled=True, iSnapshot=lambda: snapshots.append(1) or {'page': 0.5})
+    counter = registry.counter('requests_total', 'R', ('endpoint', 'status'))
+    gauge = registry.gauge('in_flight', 'F')
+    registry.collected('hit_ratio', 'Ratio', ('cache',), 'gauge', lambda s: {('page',): s['page'], ('a"b',): 1.0})
+    registry.collected('hits_total', 'Hits', ('cache',), 'counter', lambda s: {('page',): 3})
+    counter.inc(('api', '200'))
+    counter.inc(('api', '200'))
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    lines = registry.render().splitlines()
+    assert 'requests_total{endpoint="api",status="200"} 2' in lines
+    assert 'in_flight 1' in lines
+    assert 'hit_ratio{cache="page"} 0.5' in lines
+    assert 'hit_ratio{cache="a\\"b"} 1.0' in lines
+    assert '# TYPE hit_ratio gauge' in lines
+    assert 'hits_total{cache="page"} 3' in lines
+    assert len(snapshots) == 1
+
+def test_profiler_keeps_slowest():
+    profiler = RequestProfiler(iRate=1, iKeep=2, iRandom=lambda: 0.0)
+    for aName, aDuration in [('/a', 0.3), ('/b', 0.1), ('/c', 0.2)]:
+        profile = profiler.start()
+        time.sleep(0.001)
+        profiler.stop(profile, aName, aDuration)
+    report = profiler.report()
+    assert report.startswith('3 requests profiled, 2 slowest kept')
+    assert report.index('/a in 300.0 ms') < report.index('/c in 200.0 ms')
+    assert '/b in' not in report
+    assert RequestProfiler(iRate=0).start() is None
@@ -0,0 +1,36 @@
+from gmet.scheduler import PrefetchScheduler, RateBudget
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ratebudget():
+    clock = FakeClock()
+    budget = RateBudget(iRatePerMinute=60, iBurst=2, iClock=clock)
+    assert budget.tryAcquire()
+    assert budget.tryAcquire()
+    assert not budget.tryAcquire()
+    clock.now += 1
+    assert budget.tryAcquire()
+
+def test_runOnce_refreshes_due_targets_within_budget():
+    refreshed = []
+    scheduler = PrefetchScheduler(lambda: ['060180', '315550', '330630', '751010'],
+                                  lambda k: k != '315550',
+                                  refreshed.append,
+                                  iInterval=0.01, iBudget=RateBudget(iRatePerMinute=1, iBurst=2))
+    assert scheduler.runOnce() == ['060180', '330630']
+    assert refreshed == ['060180', '330630']
+    assert scheduler.stats()['skipped'] == 1
+
+def test_runOnce_counts_errors():
+    def failing(iKey):
+        raise IOError('upstream down')
+    scheduler = PrefetchScheduler(lambda: ['060180'], lambda k: True, failing, iInterval=0.01)
+    assert scheduler.runOnce() == []
+    assert scheduler.stats()['errors'] == 1
@@ -0,0 +1,13 @@
+from gmet.snapshot import SnapshotStore
+
+
+def test_snapshot_roundtrip(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'gmet'), iClock=lambda: 1000.0)
+    assert store.loadForecast('060180') is None
+    assert store.saveForecast('060180', {'result': {'ville': {'nom': 'Biot'}}})
+    assert store.loadForecast('060180') == (1000.0, {'result': {'ville': {'nom': 'Biot'}}})
+
+def test_snapshot_from_other_format_is_ignored(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    (tmp_path / 'forecast-060180').write_bytes(b'{"result": {}}')
+    assert store.loadForecast('060180') is None
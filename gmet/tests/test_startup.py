@@ -0,0 +1,30 @@
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Modules of the web server and of the HTML output, that the terminal output must not load.
+#The startup time itself is measured by benchStartup in benchmark.py
+HEAVY_MODULES = ['flask', 'werkzeug', 'jinja2', 'jproperties', 'asyncio', 'sqlite3', 'http.client', 'concurrent.futures']
+
+
+def runPython(iArgs):
+    return subprocess.run([sys.executable] + iArgs, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+
+
+def test_cli_does_not_load_web_stack():
+    aScript = ("import sys, json, runpy\n"
+               "sys.argv = ['gmet', '--version']\n"
+               "try:\n"
+               "    runpy.run_module('gmet', run_name='__main__')\n"
+               "except SystemExit:\n"
+               "    pass\n"
+               "print(json.dumps(sorted(sys.modules)))\n")
+    aModules = json.loads(runPython(['-c', aScript]).stdout.splitlines()[-1])
+    assert [m for m in HEAVY_MODULES if m in aModules] == []
+
+def test_web_app_still_available():
+    aScript = "import gmet, sys; print(gmet.app.name, 'flask' in sys.modules)"
+    assert runPython(['-c', aScript]).stdout.split() == ['gmet.web', 'True']
@@ -0,0 +1,39 @@
+from gmet.topk import FrequentTracker
+from gmet.backends import MemoryBackend
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_top_order():
+    tracker = FrequentTracker(MemoryBackend())
+    for aCity in ['Biot', 'Paris', 'Biot', 'Lyon', 'Paris', 'Biot']:
+        tracker.offer(aCity)
+    assert tracker.top(2) == ['Biot', 'Paris']
+    assert tracker.top(10) == ['Biot', 'Paris', 'Lyon']
+
+def test_memory_is_bounded_and_heavy_hitters_survive():
+    tracker = FrequentTracker(MemoryBackend(), iCapacity=16)
+    for i in range(500):
+        tracker.offer('Biot')
+    for i in range(2000):
+        tracker.offer('random-{}'.format(i))
+        if i % 5 == 0:
+            tracker.offer('Toulouse')
+    assert len(tracker.counts()) <= 16
+    assert tracker.top(2) == ['Biot', 'Toulouse']
+
+def test_decay():
+    clock = FakeClock()
+    tracker = FrequentTracker(MemoryBackend(), iHalfLife=100, iClock=clock)
+    for i in range(8):
+        tracker.offer('Biot')
+    tracker.offer('Paris')
+    clock.now += 101
+    tracker.offer('Lyon')
+    assert tracker.counts() == {'Biot': 4, 'Lyon': 1}
@@ -0,0 +1,187 @@
+import json
+import time
+import asyncio
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from gmet.upstream import UpstreamClient, UpstreamError, UpstreamTimeout, CircuitBreaker, CircuitOpen, NotSent, isHostDown
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith('/slow'):
+            time.sleep(0.3)
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        #/fail always fails, /flaky fails on its first two calls
+        if self.path.startswith('/fail') or (self.path.startswith('/flaky') and self.server.paths.count(self.path) <= 2):
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        aBody = json.dumps({'path': self.path}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(aBody)))
+        self.end_headers()
+        self.wfile.write(aBody)
+
+    def log_message(self, *iArgs):
+        pass
+
+
+@pytest.fixture
+def server():
+    aServer = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    aServer.paths = []
+    aThread = threading.Thread(target=aServer.serve_forever, daemon=True)
+    aThread.start()
+    yield aServer
+    aServer.shutdown()
+    aServer.server_close()
+
+def url(iServer, iPath):
+    return 'http://127.0.0.1:{}{}'.format(iServer.server_address[1], iPath)
+
+
+def test_keepalive_connection_reused(server):
+    client = UpstreamClient()
+    assert client.getJson(url(server, '/a'))['path'] == '/a'
+    assert client.getJson(url(server, '/b'))['path'] == '/b'
+    stats = client.stats()['hosts']['127.0.0.1:{}'.format(server.server_address[1])]
+    assert stats['connections'] == 1
+    assert stats['reused'] == 1
+
+def test_concurrent_requests_are_coalesced(server):
+    client = UpstreamClient()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.getJson(url(server, '/slow/060180')))) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 5
+    assert server.paths == ['/slow/060180']
+    assert client.stats()['coalesced'] == 4
+
+def test_errors_and_timeouts(server):
+    client = UpstreamClient(iReadTimeout=0.1)
+    with pytest.raises(UpstreamError):
+        client.getJson(url(server, '/missing'))
+    with pytest.raises(UpstreamTimeout):
+        client.getJson(url(server, '/slow'))
+
+def test_non_ascii_path_is_quoted(server):
+    client = UpstreamClient()
+    assert client.getJson(url(server, '/getLieux/Èze.json'))['path'] == '/getLieux/%C3%88ze.json'
+
+def test_getJsonAsync(server):
+    client = UpstreamClient()
+    async def fetchAll():
+        return await asyncio.gather(*[client.getJsonAsync(url(server, '/async/{}'.format(i))) for i in range(3)])
+    assert [r['path'] for r in asyncio.run(fetchAll())] == ['/async/0', '/async/1', '/async/2']
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker_states():
+    clock = FakeClock()
+    breaker = CircuitBreaker(iFailureThreshold=2, iResetTimeout=30, iClock=clock)
+    breaker.recordFailure()
+    assert breaker.allow()
+    breaker.recordFailure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now = 30
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.recordFailure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now = 60
+    assert breaker.allow()
+    breaker.recordSuccess()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats() == {'breaker': 'closed', 'failures': 0, 'breakerOpenings': 2, 'rejected': 2}
+
+def test_isHostDown():
+    assert isHostDown(CircuitOpen('open'))
+    assert isHostDown(UpstreamTimeout('slow'))
+    assert isHostDown(UpstreamError('connection lost'))
+    assert isHostDown(UpstreamError('HTTP 503', 503))
+    assert not isHostDown(UpstreamError('HTTP 404', 404))
+    assert not isHostDown(ValueError('Unknown Input City name'))
+
+def test_failures_are_retried_with_backoff(server):
+    client = UpstreamClient(iMaxRetries=2, iBackoff=0.01)
+    assert client.getJson(url(server, '/flaky'))['path'] == '/flaky'
+    assert server.paths == ['/flaky'] * 3
+    assert client.stats()['retried'] == 2
+
+def test_client_errors_are_not_retried(server):
+    client = UpstreamClient(iMaxRetries=2, iBackoff=0.01)
+    with pytest.raises(UpstreamError):
+        client.getJson(url(server, '/missing'))
+    assert server.paths == ['/missing']
+    assert client.stats()['hosts']['127.0.0.1:{}'.format(server.server_address[1])]['breaker'] == 'closed'
+
+def test_breaker_opens_and_rejects_without_calling(server):
+    client = UpstreamClient(iMaxRetries=1, iBackoff=0.01, iBreakerFailures=3, iBreakerReset=60)
+    with pytest.raises(UpstreamError):
+        client.getJson(url(server, '/fail/1'))
+    with pytest.raises(UpstreamError):
+        client.getJson(url(server, '/fail/2'))
+    assert len(server.paths) == 3
+    with pytest.raises(CircuitOpen):
+        client.getJson(url(server, '/a'))
+    assert len(server.paths) == 3
+    stats = client.stats()['hosts']['127.0.0.1:{}'.format(server.server_address[1])]
+    assert stats['breaker'] == 'open'
+    assert stats['rejected'] == 2
+
+def test_deadline_bounds_retries_and_timeouts(server):
+    client = UpstreamClient(iReadTimeout=5, iMaxRetries=5, iBackoff=0.05, iBreakerFailures=100)
+    start = time.monotonic()
+    with client.deadline(0.2):
+        with pytest.raises(UpstreamTimeout):
+            client.getJson(url(server, '/slow'))
+    assert time.monotonic() - start < 0.5
+    with client.deadline(0.2):
+        with pytest.raises(UpstreamError):
+            client.getJson(url(server, '/fail'))
+    assert time.monotonic() - start < 1
+    assert client.getJson(url(server, '/slow'))['path'] == '/slow'
+
+def test_calls_not_sent_do_not_count_as_failures(server):
+    client = UpstreamClient(iMaxRetries=0, iBreakerFailures=3, iBreakerReset=0)
+    for i in range(3):
+        with client.deadline(-1):
+            with pytest.raises(NotSent):
+                client.getJson(url(server, '/a'))
+    assert server.paths == []
+    assert client.getJson(url(server, '/a'))['path'] == '/a'
+    host = '127.0.0.1:{}'.format(server.server_address[1])
+    assert client.stats()['hosts'][host]['failures'] == 0
+
+    #An open breaker lets a probe through, a call not sent gives it back instead of leaving the breaker half-open
+    for i in range(3):
+        with pytest.raises(UpstreamError):
+            client.getJson(url(server, '/fail/{}'.format(i)))
+    assert client.stats()['hosts'][host]['breaker'] == 'open'
+    with client.deadline(-1):
+        with pytest.raises(NotSent):
+            client.getJson(url(server, '/b'))
+    assert client.stats()['hosts'][host]['breaker'] == 'open'
+    assert client.getJson(url(server, '/b'))['path'] == '/b'
+    assert client.stats()['hosts'][host]['breaker'] == 'closed'
@@ -0,0 +1,92 @@
+import os
+import json
+import pytest
+import gmet as web
+from gmet import gmet
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+def loadData(iName):
+    with open(os.path.join(DATA_DIR, iName), encoding='utf-8') as f:
+        return json.load(f)
+
+BIOT = ['060180', 'Biot', '06410', 'Alpes-Maritimes', '06', 'France']
+
+
+@pytest.fixture
+def client(monkeypatch):
+    def getInseeCode(iCityName, iInseeCode=None):
+        if iCityName.lower() != 'biot':
+            raise ValueError('Unknown Input City name: ' + iCityName)
+        return list(BIOT)
+    monkeypatch.setattr(gmet, 'serverConfigured', True)
+    monkeypatch.setattr(gmet, 'forecastCache', gmet.TTLCache(iTTL=60, iVersionFunc=gmet.getForecastVersion))
+    monkeypatch.setattr(gmet, 'getInseeCode', getInseeCode)
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', lambda iCityInseeCode: loadData('getDetail_060180.json'))
+    return web.app.test_client()
+
+
+def test_batch(client):
+    response = client.get('/batch?city=Biot&city=060180&city=Nomatch')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(l) for l in response.get_data(as_text=True).splitlines()]
+    assert sorted(l['city'] for l in lines) == ['060180', 'Biot', 'Nomatch']
+    assert [l['forecast']['nom'] for l in lines if 'forecast' in l] == ['Biot', 'Biot']
+    assert [l['city'] for l in lines if 'error' in l] == ['Nomatch']
+
+def test_api_json_and_revalidation(client):
+    response = client.get('/api/Biot')
+    assert response.status_code == 200
+    assert response.get_json()['nom'] == 'Biot'
+    assert response.headers['ETag'].startswith('W/')
+    assert 'Last-Modified' in response.headers
+    assert client.get('/api/biot', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/api/060180', headers={'If-Modified-Since': response.headers['Last-Modified']}).status_code == 304
+
+def test_api_unknown_insee_code(client, monkeypatch):
+    from gmet.upstream import UpstreamError
+    def getDetail(iCityInseeCode):
+        raise UpstreamError('HTTP 404 from getDetail', 404 if iCityInseeCode == '999999' else 503)
+    monkeypatch.setattr(gmet, 'getDataFromMeteoFranceAPI', getDetail)
+    assert client.get('/api/999999').status_code == 404
+    assert client.get('/api/060180').status_code == 503
+
+def test_api_ndjson(client):
+    response = client.get('/api/Biot?format=ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(l) for l in response.get_data(as_text=True).splitlines()]
+    assert lines[0]['nom'] == 'Biot'
+    assert len(lines) == 11
+    assert lines[1]['date'] == 'lun. - 01 juin'
+
+def test_api_unknown_city(client):
+    response = client.get('/api/Nomatch')
+    assert response.status_code == 404
+    assert 'error' in response.get_json()
+
+def test_metrics(client, monkeypatch):
+    monkeypatch.setattr(gmet.metricsRegistry, 'enabled', False)
+    assert client.get('/metrics').status_code == 404
+
+    monkeypatch.setattr(gmet.metricsRegistry, 'enabled', True)
+    monkeypatch.setattr(gmet, 'pageCache', gmet.TTLCache(iTTL=60, iName='page'))
+    assert client.get('/api/Biot').status_code == 200
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert [l for l in lines if l.startswith('gmet_request_seconds_count{endpoint="api"}')]
+    assert [l for l in lines if l.startswith('gmet_stage_seconds_count{stage="buildCleanObject"}')]
+    assert [l for l in lines if l.startswith('gmet_requests_total{endpoint="api",status="200"}')]
+    assert [l for l in lines if l.startswith('gmet_cache_hit_ratio{cache="forecast"}')]
+    assert 'gmet_requests_in_flight 1' in lines
+
+def test_stats_and_metrics_with_backend_down(client, monkeypatch):
+    from gmet.backends import RedisBackend
+    monkeypatch.setattr(gmet.metricsRegistry, 'enabled', True)
+    monkeypatch.setattr(gmet.requestTracker, 'backend', RedisBackend('127.0.0.1', 1))
+    response = client.get('/stats')
+    assert response.status_code == 200
+    assert response.get_json()['frequent']['size'] is None
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert [l for l in response.get_data(as_text=True).splitlines() if l.startswith('gmet_cache_backend_errors_total{cache="frequent"}')]
@@ -0,0 +1,108 @@
+#Local stand-in for ipinfo.io and ws.meteofrance.com, replaying the answers recorded in the data directory:
+#ipinfo.json for /<ip>, getLieux_<name>.json for /getLieux/<name>.json (no recording means no matching city),
+#getDetail_<insee>.json for /getDetail/france/<insee>.json (without recording, the Biot forecast for the city of that INSEE code,
+#as found in the getLieux recordings).
+#Latency and failures can be injected, failures being drawn from a seeded generator so that runs are reproducible.
+
+import os
+import json
+import time
+import random
+import threading
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+DEFAULT_DETAIL = 'getDetail_060180.json'
+
+
+def loadRecording(iName):
+    try:
+        with open(os.path.join(DATA_DIR, iName), encoding='utf-8') as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+class UpstreamStandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def answer(self, iPath):
+        aParts = [unquote(p) for p in iPath.split('?')[0].strip('/').split('/') if p]
+        if len(aParts) >= 2 and aParts[-2] == 'getLieux':
+            aName = aParts[-1][:-len('.json')].strip().lower()
+            return self.server.recording('getLieux_{}.json'.format(aName)) or {'result': {'france': []}}
+        if len(aParts) >= 3 and aParts[-3] == 'getDetail':
+            aInseeCode = aParts[-1][:-len('.json')]
+            aData = self.server.recording('getDetail_{}.json'.format(aInseeCode))
+            if aData is None:
+                aData = json.loads(json.dumps(self.server.recording(DEFAULT_DETAIL)))
+                aData['result']['ville'].update(self.server.city(aInseeCode))
+            return aData
+        aData = dict(self.server.recording('ipinfo.json'))
+        if aParts:
+            aData['ip'] = aParts[-1]
+        return aData
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.paths.append(self.path)
+            aFails = self.server.random.random() < self.server.failureRate
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if aFails:
+            aStatus, aBody = 503, b'{"error": "injected failure"}'
+        else:
+            aStatus, aBody = 200, json.dumps(self.answer(self.path), ensure_ascii=False).encode('utf-8')
+        self.send_response(aStatus)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(aBody)))
+        self.end_headers()
+        self.wfile.write(aBody)
+
+    def log_message(self, *iArgs):
+        pass
+
+
+class UpstreamStandin(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, iLatency=0, iFailureRate=0, iSeed=0):
+        super().__init__(('127.0.0.1', 0), UpstreamStandinHandler)
+        self.latency = iLatency
+        self.failureRate = iFailureRate
+        self.random = random.Random(iSeed)
+        self.lock = threading.Lock()
+        self.paths = []
+        self._recordings = {}
+        self._cities = None
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    #Recordings are parsed once, answers are serialized again for each request like a live service would
+    def recording(self, iName):
+        with self.lock:
+            if iName not in self._recordings:
+                self._recordings[iName] = loadRecording(iName)
+            return self._recordings[iName]
+
+    #Fields of the city of iInseeCode in the getLieux recordings, at least its INSEE code
+    def city(self, iInseeCode):
+        with self.lock:
+            if self._cities is None:
+                self._cities = {}
+                for aName in sorted(os.listdir(DATA_DIR)):
+                    if aName.startswith('getLieux_'):
+                        for e in loadRecording(aName)['result']['france']:
+                            self._cities[e['indicatif']] = {k: e[k] for k in ('indicatif', 'nom', 'codePostal', 'nomDept', 'numDept', 'pays', 'region')}
+            return self._cities.get(iInseeCode, {'indicatif': iInseeCode})
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+#Start a stand-in on a free local port, answering both the ipinfo and the meteofrance urls. Stop it with stop()
+def startUpstreamStandin(iLatency=0, iFailureRate=0, iSeed=0):
+    aServer = UpstreamStandin(iLatency, iFailureRate, iSeed)
+    threading.Thread(target=aServer.serve_forever, daemon=True).start()
+    return aServer
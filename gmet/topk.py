@@ -0,0 +1,85 @@
+#Bounded tracker of the most requested cities, replacing an ever growing dict of request counts
+
+import time
+import heapq
+import logging
+import threading
+
+
+#Space-Saving heavy hitters: at most iCapacity counters are kept, in a counter hash of a cache backend (see backends.py) so that
+#all the workers sharing the backend share the counts. When a new item arrives and the table is full, the item with the lowest
+#count is replaced and the new one inherits that count plus one, so that frequent items can never be pushed out by a flood of
+#distinct rare ones. With iHalfLife (seconds), all the counts are halved that often so that frequent means recently frequent.
+class FrequentTracker(object):
+
+    def __init__(self, iBackend, iName='requests', iCapacity=256, iHalfLife=None, iClock=time.time):
+        self.backend = iBackend
+        self.name = iName
+        self.capacity = iCapacity
+        self.halfLife = iHalfLife
+        self._clock = iClock
+        self._lock = threading.Lock()
+        self._decayedAt = iClock()
+        self.evictions = 0
+        self.backendErrors = 0
+
+    def offer(self, iItem):
+        if self.halfLife:
+            self._decayIfDue()
+        if self.backend.incr(self.name, iItem) > 1:
+            return
+        #New item: make room if needed
+        aCounters = self.backend.getCounters(self.name)
+        while len(aCounters) > self.capacity:
+            aVictim, aMinCount = min(((k, c) for k, c in aCounters.items() if k != iItem), key=lambda x: x[1])
+            self.backend.deleteCounter(self.name, aVictim)
+            del aCounters[aVictim]
+            aCounters[iItem] = aMinCount + 1
+            self.backend.setCounter(self.name, iItem, aMinCount + 1)
+            with self._lock:
+                self.evictions += 1
+
+    #The iK most frequent items, most frequent first (ties in insertion order)
+    def top(self, iK):
+        aCounters = self.backend.getCounters(self.name)
+        return [k for k, c in heapq.nlargest(iK, aCounters.items(), key=lambda x: x[1])]
+
+    def counts(self):
+        return self.backend.getCounters(self.name)
+
+    #Halve all the counts once per half life. With a shared backend, the last decay time is shared too
+    def _decayIfDue(self):
+        aNow = self._clock()
+        with self._lock:
+            if aNow - self._decayedAt < self.halfLife:
+                return
+            self._decayedAt = aNow
+        aDecayedAt = self.backend.get(self.name + ':decayedAt')
+        if aDecayedAt is not None and aNow - float(aDecayedAt) < self.halfLife:
+            with self._lock:
+                self._decayedAt = float(aDecayedAt)
+            return
+        self.backend.set(self.name + ':decayedAt', repr(aNow))
+        for aItem, aCount in self.backend.getCounters(self.name).items():
+            if aCount // 2 > 0:
+                self.backend.setCounter(self.name, aItem, aCount // 2)
+            else:
+                self.backend.deleteCounter(self.name, aItem)
+        logging.debug("Request counters of {} decayed".format(self.name))
+
+    #Statistics stay available while the backend is down, the size is then None
+    def stats(self):
+        try:
+            aSize = len(self.backend.getCounters(self.name))
+        except IOError as error:
+            logging.warning("Request counters of {} not available: {}".format(self.name, error))
+            aSize = None
+            with self._lock:
+                self.backendErrors += 1
+        return {
+            'capacity':      self.capacity,
+            'halfLife':      self.halfLife,
+            'size':          aSize,
+            'evictions':     self.evictions,
+            'backendErrors': self.backendErrors
+            }
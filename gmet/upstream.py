@@ -0,0 +1,443 @@
+#Shared HTTP client for the upstream services (ipinfo.io, ws.meteofrance.com): persistent connections per host,
+#per host concurrency limits, explicit connect and read timeouts, and coalescing of identical concurrent requests.
+#Failing hosts are isolated by a circuit breaker, failed calls are retried a bounded number of times with a jittered backoff,
+#and the calls made for one web request can share a deadline.
+#http.client and asyncio are imported on first use, the command line does not need them when it prints from its snapshots
+
+import json
+import time
+import random
+import socket
+import threading
+from urllib.parse import urlsplit, urljoin, quote
+
+
+class UpstreamError(IOError):
+    def __init__(self, iMessage, iStatus=None):
+        super().__init__(iMessage)
+        self.status = iStatus
+
+
+class UpstreamTimeout(UpstreamError):
+    pass
+
+
+#Raised without calling the host while its circuit breaker is open
+class CircuitOpen(UpstreamError):
+    pass
+
+
+#Raised before the request was sent: the deadline was already passed or too many requests were in flight.
+#The host was not called, so its circuit breaker does not count it
+class NotSent(UpstreamTimeout):
+    pass
+
+
+#True when iError means the host is failing or isolated (no answer, timeout, open breaker, server error), False when
+#it answered and rejected the request (e.g. 404 for an unknown name)
+def isHostDown(iError):
+    if isinstance(iError, (CircuitOpen, UpstreamTimeout)):
+        return True
+    return isinstance(iError, UpstreamError) and (iError.status is None or UpstreamClient.isHostFailure(iError.status))
+
+
+#Smallest of iTimeout and the time left before iDeadline (a time.monotonic value, None for no deadline)
+def getTimeout(iTimeout, iDeadline, iHost):
+    if iDeadline is None:
+        return iTimeout
+    aLeft = iDeadline - time.monotonic()
+    if aLeft <= 0:
+        raise NotSent('Deadline exceeded before calling {}'.format(iHost))
+    return min(iTimeout, aLeft)
+
+
+#Circuit breaker of one host: after iFailureThreshold consecutive failures it opens and calls are rejected right away.
+#After iResetTimeout seconds one probe call is let through (half-open): its success closes the breaker, its failure opens it again
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half-open'
+    OPEN = 'open'
+    STATES = (CLOSED, HALF_OPEN, OPEN)
+
+    def __init__(self, iFailureThreshold=5, iResetTimeout=30, iClock=time.monotonic):
+        self.failureThreshold = iFailureThreshold
+        self.resetTimeout = iResetTimeout
+        self._clock = iClock
+        self._lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.openings = 0
+        self.rejected = 0
+
+    #Return True when a call may be made now
+    def allow(self):
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and self._clock() - self.openedAt >= self.resetTimeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def recordSuccess(self):
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def recordFailure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or (self.state == CircuitBreaker.CLOSED and self.failures >= self.failureThreshold):
+                self.state = CircuitBreaker.OPEN
+                self.openedAt = self._clock()
+                self.openings += 1
+
+    #The allowed call was not made: a half-open breaker gets its probe back, the counts are unchanged
+    def cancel(self):
+        with self._lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.state = CircuitBreaker.OPEN
+
+    def stats(self):
+        with self._lock:
+            return {
+                'breaker':         self.state,
+                'failures':        self.failures,
+                'breakerOpenings': self.openings,
+                'rejected':        self.rejected
+                }
+
+
+#Deadline of the upstream calls made by the current thread inside a with block, nested blocks can only shorten it
+class Deadline(object):
+
+    def __init__(self, iLocal, iSeconds):
+        self._local = iLocal
+        self._seconds = iSeconds
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(self._local, 'deadline', None)
+        aDeadline = time.monotonic() + self._seconds
+        self._local.deadline = aDeadline if self._previous is None else min(aDeadline, self._previous)
+        return self
+
+    def __exit__(self, *iExcInfo):
+        self._local.deadline = self._previous
+        return False
+
+
+#Run a function once for all the concurrent callers asking for the same key: the first caller runs it,
+#the others wait for its result (or its exception)
+class SingleFlight(object):
+
+    class Call(object):
+        __slots__ = ('event', 'result', 'error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    #iTimeout bounds the wait of the callers joining a running call, the first caller is bounded by iFunc itself
+    def do(self, iKey, iFunc, iTimeout=None):
+        with self._lock:
+            aCall = self._calls.get(iKey)
+            aLeader = aCall is None
+            if aLeader:
+                aCall = self._calls[iKey] = SingleFlight.Call()
+            else:
+                self.coalesced += 1
+        if not aLeader:
+            if not aCall.event.wait(iTimeout):
+                raise UpstreamTimeout('Deadline exceeded waiting for {}'.format(iKey))
+            if aCall.error is not None:
+                raise aCall.error
+            return aCall.result
+
+        try:
+            aCall.result = iFunc()
+            return aCall.result
+        except BaseException as error:
+            aCall.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[iKey]
+            aCall.event.set()
+
+
+#Idle keep-alive connections to one host, with at most iMaxConnections requests in flight
+class ConnectionPool(object):
+
+    def __init__(self, iScheme, iHost, iPort, iMaxConnections=4, iConnectTimeout=3, iReadTimeout=10):
+        self.scheme = iScheme
+        self.host = iHost
+        self.port = iPort
+        self.connectTimeout = iConnectTimeout
+        self.readTimeout = iReadTimeout
+        self._slots = threading.BoundedSemaphore(iMaxConnections)
+        self._lock = threading.Lock()
+        self._idle = []
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.httpErrors = 0
+
+    def _connect(self, iConnectTimeout):
+        import http.client
+        aClass = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        aConnection = aClass(self.host, self.port, timeout=iConnectTimeout)
+        aConnection.connect()
+        aConnection.sock.settimeout(self.readTimeout)
+        with self._lock:
+            self.connections += 1
+        return aConnection
+
+    def _acquire(self, iConnectTimeout):
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop(), True
+        return self._connect(iConnectTimeout), False
+
+    def _release(self, iConnection, iResponse):
+        if iResponse.will_close:
+            iConnection.close()
+            return
+        with self._lock:
+            self._idle.append(iConnection)
+
+    #Send a GET request, return (status, headers, body). A reused connection closed by the server is retried once on a new one.
+    #Timeouts are shortened to end by iDeadline (time.monotonic) when given
+    def request(self, iPath, iHeaders, iDeadline=None):
+        import http.client
+        if not self._slots.acquire(timeout=getTimeout(self.connectTimeout + self.readTimeout, iDeadline, self.host)):
+            with self._lock:
+                self.timeouts += 1
+            raise NotSent('Too many requests in flight to {}'.format(self.host))
+        try:
+            with self._lock:
+                self.requests += 1
+            for aAttempt in range(2):
+                aConnection = None
+                aReused = False
+                aReadTimeout = getTimeout(self.readTimeout, iDeadline, self.host)
+                try:
+                    aConnection, aReused = self._acquire(min(self.connectTimeout, aReadTimeout))
+                    if aConnection.sock is not None:
+                        aConnection.sock.settimeout(aReadTimeout)
+                    aConnection.request('GET', iPath, headers=iHeaders)
+                    aResponse = aConnection.getresponse()
+                    aBody = aResponse.read()
+                    self._release(aConnection, aResponse)
+                    if aResponse.status >= 400:
+                        with self._lock:
+                            self.httpErrors += 1
+                    return aResponse.status, aResponse, aBody
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as error:
+                    if aConnection is not None:
+                        aConnection.close()
+                    if aReused and aAttempt == 0:
+                        continue
+                    with self._lock:
+                        self.errors += 1
+                    raise UpstreamError('Connection to {} lost: {}'.format(self.host, error))
+                except socket.timeout as error:
+                    if aConnection is not None:
+                        aConnection.close()
+                    with self._lock:
+                        self.timeouts += 1
+                    raise UpstreamTimeout('Timeout from {}: {}'.format(self.host, error))
+                except (OSError, http.client.HTTPException) as error:
+                    if aConnection is not None:
+                        aConnection.close()
+                    with self._lock:
+                        self.errors += 1
+                    raise UpstreamError('Request to {} failed: {}'.format(self.host, error))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            aIdle, self._idle = self._idle, []
+        for aConnection in aIdle:
+            aConnection.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests':    self.requests,
+                'connections': self.connections,
+                'reused':      self.reused,
+                'idle':        len(self._idle),
+                'errors':      self.errors,
+                'timeouts':    self.timeouts,
+                'httpErrors':  self.httpErrors
+                }
+
+
+#Client shared by all the upstream calls of the process. get() and getJson() are blocking and safe to call
+#from the Flask threads, getJsonAsync() runs the same request from an asyncio event loop
+class UpstreamClient(object):
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, iMaxConnectionsPerHost=4, iConnectTimeout=3, iReadTimeout=10, iMaxRedirects=3,
+                 iMaxRetries=2, iBackoff=0.1, iBreakerFailures=5, iBreakerReset=30, iRandom=random.random):
+        self.maxConnectionsPerHost = iMaxConnectionsPerHost
+        self.connectTimeout = iConnectTimeout
+        self.readTimeout = iReadTimeout
+        self.maxRedirects = iMaxRedirects
+        self.maxRetries = iMaxRetries
+        self.backoff = iBackoff
+        self.breakerFailures = iBreakerFailures
+        self.breakerReset = iBreakerReset
+        self._random = iRandom
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._breakers = {}
+        self._local = threading.local()
+        self._singleFlight = SingleFlight()
+        self.retried = 0
+
+    def configure(self, iMaxConnectionsPerHost=None, iConnectTimeout=None, iReadTimeout=None, iMaxRetries=None, iBackoff=None,
+                  iBreakerFailures=None, iBreakerReset=None):
+        with self._lock:
+            if iMaxConnectionsPerHost is not None:
+                self.maxConnectionsPerHost = iMaxConnectionsPerHost
+            if iConnectTimeout is not None:
+                self.connectTimeout = iConnectTimeout
+            if iReadTimeout is not None:
+                self.readTimeout = iReadTimeout
+            if iMaxRetries is not None:
+                self.maxRetries = iMaxRetries
+            if iBackoff is not None:
+                self.backoff = iBackoff
+            if iBreakerFailures is not None:
+                self.breakerFailures = iBreakerFailures
+            if iBreakerReset is not None:
+                self.breakerReset = iBreakerReset
+            for aBreaker in self._breakers.values():
+                aBreaker.failureThreshold = self.breakerFailures
+                aBreaker.resetTimeout = self.breakerReset
+            aPools, self._pools = self._pools, {}
+        for aPool in aPools.values():
+            aPool.close()
+
+    #Pool and circuit breaker of a host. Breakers survive configure(), a reconfiguration does not heal a failing host
+    def _getPool(self, iScheme, iHost, iPort):
+        aKey = (iScheme, iHost, iPort)
+        with self._lock:
+            aPool = self._pools.get(aKey)
+            if aPool is None:
+                aPool = self._pools[aKey] = ConnectionPool(iScheme, iHost, iPort, self.maxConnectionsPerHost, self.connectTimeout, self.readTimeout)
+            aBreaker = self._breakers.get(aKey)
+            if aBreaker is None:
+                aBreaker = self._breakers[aKey] = CircuitBreaker(self.breakerFailures, self.breakerReset)
+            return aPool, aBreaker
+
+    #Bound the total time of the upstream calls made by this thread in a with block, e.g. for one web request
+    def deadline(self, iSeconds):
+        return Deadline(self._local, iSeconds)
+
+    #Server errors and throttling count as failures of the host, other HTTP errors are valid answers
+    @staticmethod
+    def isHostFailure(iStatus):
+        return iStatus >= 500 or iStatus == 429
+
+    def _fetchOnce(self, iUrl, iDeadline):
+        aUrl = iUrl
+        for aRedirect in range(self.maxRedirects + 1):
+            aParts = urlsplit(aUrl)
+            aPath = quote(aParts.path or '/', safe="/:@!$&'()*+,;=-._~%")
+            if aParts.query:
+                aPath += '?' + aParts.query
+            aPool, aBreaker = self._getPool(aParts.scheme, aParts.hostname, aParts.port)
+            if not aBreaker.allow():
+                raise CircuitOpen('Circuit open for {}, not calling {}'.format(aParts.hostname, iUrl))
+            try:
+                aStatus, aResponse, aBody = aPool.request(aPath, {'Accept': 'application/json', 'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}, iDeadline)
+            except NotSent:
+                aBreaker.cancel()
+                raise
+            except BaseException:
+                aBreaker.recordFailure()
+                raise
+            if UpstreamClient.isHostFailure(aStatus):
+                aBreaker.recordFailure()
+            else:
+                aBreaker.recordSuccess()
+            if aStatus in UpstreamClient.REDIRECTS and aResponse.getheader('Location'):
+                aUrl = urljoin(aUrl, aResponse.getheader('Location'))
+                continue
+            if aStatus >= 400:
+                raise UpstreamError('HTTP {} from {}'.format(aStatus, iUrl), aStatus)
+            if aResponse.getheader('Content-Encoding') == 'gzip':
+                import gzip
+                aBody = gzip.decompress(aBody)
+            return aBody
+        raise UpstreamError('Too many redirects from {}'.format(iUrl))
+
+    #Connection errors, timeouts and host failures are retried up to maxRetries times, after a random delay of up to
+    #backoff, 2*backoff, 4*backoff... seconds (full jitter), unless the breaker opens or the deadline would be passed meanwhile
+    def _fetch(self, iUrl, iDeadline):
+        aAttempt = 0
+        while True:
+            try:
+                return self._fetchOnce(iUrl, iDeadline)
+            except CircuitOpen:
+                raise
+            except UpstreamError as error:
+                if aAttempt >= self.maxRetries or (error.status is not None and not UpstreamClient.isHostFailure(error.status)):
+                    raise
+                aDelay = self._random() * self.backoff * 2 ** aAttempt
+                if iDeadline is not None and time.monotonic() + aDelay >= iDeadline:
+                    raise
+            aAttempt += 1
+            with self._lock:
+                self.retried += 1
+            time.sleep(aDelay)
+
+    #Return the body of iUrl. Concurrent requests for the same url share a single upstream call
+    def get(self, iUrl):
+        aDeadline = getattr(self._local, 'deadline', None)
+        aTimeout = None if aDeadline is None else max(0, aDeadline - time.monotonic())
+        return self._singleFlight.do(iUrl, lambda: self._fetch(iUrl, aDeadline), aTimeout)
+
+    #Each caller gets its own decoded copy, so that callers can modify it
+    def getJson(self, iUrl):
+        return json.loads(self.get(iUrl))
+
+    async def getJsonAsync(self, iUrl):
+        import asyncio
+        return await asyncio.get_event_loop().run_in_executor(None, self.getJson, iUrl)
+
+    def close(self):
+        with self._lock:
+            aPools, self._pools = self._pools, {}
+        for aPool in aPools.values():
+            aPool.close()
+
+    def stats(self):
+        with self._lock:
+            aPools = dict(self._pools)
+            aBreakers = dict(self._breakers)
+        aStats = {'coalesced': self._singleFlight.coalesced, 'retried': self.retried, 'hosts': {}}
+        for aKey in sorted(set(aPools) | set(aBreakers), key=str):
+            aScheme, aHost, aPort = aKey
+            aHostStats = aPools[aKey].stats() if aKey in aPools else {}
+            if aKey in aBreakers:
+                aHostStats.update(aBreakers[aKey].stats())
+            aStats['hosts'][aHost if aPort is None else '{}:{}'.format(aHost, aPort)] = aHostStats
+        return aStats
@@ -0,0 +1,111 @@
+#Flask application of the web server, loaded through gmet.app (see __init__.py)
+import os
+import json
+import time
+import datetime
+from flask import Flask, Response, request, send_from_directory, jsonify, g
+from gmet import gmet
+from gmet.upstream import UpstreamError
+
+app = Flask(__name__)
+
+#Request metrics: latency per endpoint, requests in flight, answers per status, and the sampled profiles of the slowest requests
+@app.before_request
+def startRequestMetrics():
+    if gmet.metricsRegistry.enabled:
+        g.metricsStart = time.perf_counter()
+        g.metricsProfile = gmet.requestProfiler.start()
+        gmet.requestsInFlight.inc()
+
+@app.after_request
+def countResponse(response):
+    gmet.requestsTotal.inc((request.endpoint or 'notfound', str(response.status_code)))
+    return response
+
+@app.teardown_request
+def stopRequestMetrics(error=None):
+    aStart = g.pop('metricsStart', None)
+    if aStart is None:
+        return
+    aDuration = time.perf_counter() - aStart
+    gmet.requestsInFlight.dec()
+    gmet.requestSeconds.observe(aDuration, (request.endpoint or 'notfound',))
+    aProfile = g.pop('metricsProfile', None)
+    if aProfile is not None:
+        gmet.requestProfiler.stop(aProfile, request.full_path, aDuration)
+
+#Static Files
+#app.add_url_rule('/favicon.ico', redirect_to=url_for('static', filename='favicon.ico'))
+@app.route('/favicon.ico')
+def favicon():
+    return send_from_directory(os.path.join(app.root_path, 'static'),
+                               'favicon.ico', mimetype='image/vnd.microsoft.icon')
+
+#Dynamic URLs
+@app.route('/')
+@app.route('/<city>')
+def meteo(city=None):
+    if 'X-Client-Ip' in request.headers:
+        aCallingIP = request.headers['X-Client-Ip']
+    else:
+        aCallingIP = request.remote_addr
+    #No forecast at all, not even an old one: fail fast, the client may come back later
+    try:
+        return gmet.runWeb(iIP=aCallingIP, iCity=city, )
+    except IOError as error:
+        return Response('Forecast not available, Meteo France is not reachable: {}\n'.format(error), status=503, mimetype='text/plain',
+                        headers={'Retry-After': str(int(gmet.upstreamClient.breakerReset))})
+
+#Forecasts of several cities as JSON lines, e.g. /batch?city=Biot&city=Bordeaux,450410&city=315550
+@app.route('/batch')
+def batch():
+    return Response(gmet.runWebBatch(request.args.getlist('city')), mimetype='application/x-ndjson')
+
+@app.route('/api/batch')
+def apiBatch():
+    return batch()
+
+#Forecast of a city as JSON, or as JSON lines (city, then one line per day) with ?format=ndjson
+#Clients revalidate with If-None-Match or If-Modified-Since and get a 304 while the upstream forecast is unchanged
+@app.route('/api/<city>')
+def api(city):
+    try:
+        aCleanData, aVersion, aModifiedAt = gmet.runApi(city, request.args.get('inseecode'))
+    except ValueError as error:
+        return jsonify({'city': city, 'error': str(error)}), 404
+    except IOError as error:
+        #Meteo France answered but rejected the request, e.g. an unknown INSEE code
+        if isinstance(error, UpstreamError) and error.status is not None and error.status < 500:
+            return jsonify({'city': city, 'error': str(error)}), 404
+        return jsonify({'city': city, 'error': str(error)}), 503
+
+    if request.args.get('format') == 'ndjson':
+        aResponse = Response(gmet.formatOutputForNdjson(aCleanData), mimetype='application/x-ndjson')
+    else:
+        aResponse = Response(json.dumps(aCleanData, ensure_ascii=False), mimetype='application/json')
+    aResponse.set_etag('{}-{}'.format(aVersion, request.args.get('format', 'json')), weak=True)
+    aResponse.last_modified = datetime.datetime.fromtimestamp(int(aModifiedAt), datetime.timezone.utc)
+    aResponse.cache_control.public = True
+    aResponse.cache_control.no_cache = True
+    return aResponse.make_conditional(request)
+
+@app.route('/stats')
+def stats():
+    return jsonify(gmet.getCacheStats())
+
+@app.route('/metrics')
+def metrics():
+    aMetrics = gmet.runMetrics()
+    if aMetrics is None:
+        return Response('Metrics are disabled\n', status=404, mimetype='text/plain')
+    return Response(aMetrics, mimetype='text/plain; version=0.0.4')
+
+#Slowest requests profiled, see metrics_profile_rate in the configuration file
+@app.route('/debug/profiles')
+def profiles():
+    return Response(gmet.requestProfiler.report(), mimetype='text/plain')
+
+@app.route('/debug')
+def debug():
+    output_buffer="HTTP headers:{} \nURL: {}".format(str(request.headers), str(request))
+    return output_buffer
\ No newline at end of file
@@ -1,3 +1,3 @@
 #!/bin/bash
 
-gunicorn --bind=0.0.0.0 --timeout 600 gmet:app
\ No newline at end of file
+gunicorn --bind=0.0.0.0 --timeout 60 gmet:app
\ No newline at end of file